@@ -0,0 +1,95 @@
+"""
+Benchmark of the duplicate index (`DuplicateIndex`), which should take roughly the same time per card however many cards
+there are (i.e. finding near-duplicates shouldn't mean comparing every pair of cards).
+
+Run from the root of the repo with:
+
+    python benchmarks/bench_duplicates.py [--sizes 1000 10000 100000] [--copy-fraction 0.05] [--output results.json]
+
+The fronts are synthetic lines of text (see `generate_notebook.py`), and some of them are copies of earlier fronts with a
+word changed, which should be found as near-duplicates. For each number of cards, this times adding every card to an
+empty index, saving it, loading it again, and finding the duplicate of every card (which is what `build` does), and
+prints how many of the copies were found.
+
+The synthetic text only uses a few dozen words, so unrelated fronts are much more similar than they would be in real
+notebooks, and more of them have to be compared (this makes the benchmark something of a worst case for `find`).
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import jupyter_to_anki
+from generate_notebook import WORDS, text_line
+
+
+def make_fronts(num_cards: int, copy_fraction: float, seed: int) -> Tuple[List[str], set]:
+    """
+    Returns the fronts, and the indices of the ones which are copies (with one word changed) of an earlier front
+    """
+    r = random.Random(seed)
+    fronts, copies = [], set()
+    for i in range(num_cards):
+        if fronts and r.random() < copy_fraction:
+            words = r.choice(fronts).split(" ")
+            words[r.randrange(len(words))] = r.choice(WORDS)
+            fronts.append(" ".join(words))
+            copies.add(i)
+        else:
+            fronts.append(" ".join(text_line(r, 0) for _ in range(r.randint(1, 3))))
+    return fronts, copies
+
+
+def timed(results: List[Dict], name: str, num_cards: int, f):
+    t0 = time.perf_counter()
+    out = f()
+    t = time.perf_counter() - t0
+    results.append({"benchmark": name, "size": num_cards, "time_s": t, "us_per_item": 1e6 * t / num_cards})
+    print(f"{name:<30} {num_cards:>8} {1000 * t:>12.1f} {1e6 * t / num_cards:>10.1f}")
+    return out
+
+
+def run(num_cards: int, copy_fraction: float, threshold: float, seed: int, tmp: Path) -> List[Dict]:
+    fronts, copies = make_fronts(num_cards, copy_fraction, seed)
+    path = tmp / f"duplicates_{num_cards}.json"
+    results = []
+    index = jupyter_to_anki.DuplicateIndex(path, threshold)
+    found = timed(results, "add", num_cards, lambda: [index.add("notebook", str(i), "Deck", i, front) for i, front in enumerate(fronts)])
+    timed(results, "save", num_cards, index.save)
+    index = timed(results, "load", num_cards, lambda: jupyter_to_anki.DuplicateIndex(path, threshold))
+    timed(results, "find", num_cards, lambda: [index.find("notebook", str(i)) for i in range(num_cards)])
+    found = {i for i, d in enumerate(found) if d is not None}
+    print(f"{'copies found':<30} {num_cards:>8} {len(found & copies):>8} / {len(copies)} ({len(found - copies)} other duplicates)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the duplicate index on synthetic fronts.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="number of cards")
+    parser.add_argument("--copy-fraction", type=float, default=0.05, help="fraction of fronts which are tweaked copies")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="where to write the results (as JSON)")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'benchmark':<30} {'cards':>8} {'time (ms)':>12} {'us/card':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_cards in args.sizes:
+            results += run(num_cards, args.copy_fraction, args.threshold, args.seed, Path(tmp))
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"\nWrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of how long it takes to import `jupyter_to_anki`, using `python -X importtime`.
+
+Run from the root of the repo with:
+
+    python benchmarks/bench_import_time.py [--budget-ms 80] [--runs 10]
+
+Importing the module shouldn't read any files, or import bs4 or genanki (these are imported when they're first used).
+This exits with an error if the median import time is over budget, or if any of these modules get imported. The budget
+is for the cumulative time of the import (including the standard library modules it imports), with bytecode cached.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# modules which shouldn't be imported when `jupyter_to_anki` is
+DEFERRED_MODULES = ["bs4", "genanki", "concurrent.futures.process", "traceback"]
+
+
+def import_time() -> tuple:
+    """
+    Imports the module in a fresh interpreter, and returns (cumulative import time in ms, names of all modules imported)
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env.pop("JUPYTER_TO_ANKI_MEDIA", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import jupyter_to_anki"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    modules, cumulative = [], None
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append(name.strip())
+        if name.strip() == "jupyter_to_anki":
+            cumulative = int(cumulative_us) / 1000
+    return cumulative, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=80.0)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    # the first import writes the bytecode cache, so it isn't counted
+    import_time()
+    times, modules = [], []
+    for _ in range(args.runs):
+        t, modules = import_time()
+        times.append(t)
+
+    median = statistics.median(times)
+    print(f"import jupyter_to_anki: median {median:.1f}ms, min {min(times):.1f}ms, max {max(times):.1f}ms (budget {args.budget_ms:.0f}ms)")
+
+    failed = False
+    if median > args.budget_ms:
+        print("FAIL: median import time is over budget")
+        failed = True
+    imported = [m for m in DEFERRED_MODULES if m in modules]
+    if imported:
+        print(f"FAIL: these modules should only be imported when they're used: {imported}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Benchmark of the two ways of writing anki packages: genanki (one `genanki.Note` per card) and the bulk SQLite writer
+(`write_collection`).
+
+Run from the root of the repo with:
+
+    python benchmarks/bench_package_writers.py [--sizes 1000 10000 100000] [--repeats 3] [--output results.json]
+
+The notes are real rendered cards (from a synthetic notebook, see `generate_notebook.py`), repeated with different GUIDs
+to get as many as we need, spread over a few decks. Before timing anything, this checks that both writers give the same
+decks, note types, notes and cards (apart from the sort field and checksum of each note, which only the bulk writer
+fills in).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import jupyter_to_anki
+from generate_notebook import generate_notebook
+
+WRITERS = ["genanki", "sqlite"]
+# timestamp used for both writers when checking they give the same package (note and card ids come from it)
+TIMESTAMP = 1700000000.0
+
+
+def rendered_cards(tmp: Path, num_cells: int, seed: int) -> Dict:
+    """
+    Renders a synthetic notebook, returning the cards as `read_cards` does (deck -> card type -> list of cards)
+    """
+    filename = tmp / "synthetic.ipynb"
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(generate_notebook(num_cells=num_cells, seed=seed), f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return jupyter_to_anki.read_cards(str(filename), True, None)
+
+
+def make_notes(cards: Dict, num_notes: int) -> Dict:
+    """
+    Repeats the cards until there are `num_notes` of them (each with its own GUID), keeping the same decks and card types
+    """
+    import genanki
+    flat = [(deck, card_type, fields, tags) for deck, card_dict_by_type in cards.items() for card_type, card_list in card_dict_by_type.items() for fields, tags, _ in card_list]
+    notes = defaultdict(lambda: defaultdict(list))
+    for i in range(num_notes):
+        deck, card_type, fields, tags = flat[i % len(flat)]
+        notes[deck][card_type].append((fields, tags, genanki.guid_for("benchmark", i)))
+    return notes
+
+
+def read_package(filename: Path, tmp: Path) -> tuple:
+    """
+    Returns the decks, note types, notes and cards in a package
+    """
+    path_db = tmp / "collection.anki2"
+    with zipfile.ZipFile(filename) as z:
+        path_db.write_bytes(z.read("collection.anki2"))
+    conn = sqlite3.connect(path_db)
+    decks, models = (json.loads(s) for s in conn.execute("SELECT decks, models FROM col").fetchone())
+    notes = conn.execute("SELECT * FROM notes ORDER BY id").fetchall()
+    cards = conn.execute("SELECT * FROM cards ORDER BY id").fetchall()
+    conn.close()
+    os.remove(path_db)
+    return decks, models, notes, cards
+
+
+def check_writers_agree(notes: Dict, tmp: Path) -> None:
+    packages = {}
+    for writer in WRITERS:
+        jupyter_to_anki.write_package(tmp / f"check_{writer}.apkg", notes, writer, timestamp=TIMESTAMP)
+        packages[writer] = read_package(tmp / f"check_{writer}.apkg", tmp)
+    (decks_g, models_g, notes_g, cards_g), (decks_s, models_s, notes_s, cards_s) = packages["genanki"], packages["sqlite"]
+    assert decks_g == decks_s, "The writers give different decks"
+    assert models_g == models_s, "The writers give different note types"
+    assert cards_g == cards_s, "The writers give different cards"
+    # columns 7 and 8 are the sort field and checksum
+    assert [n[:7] + n[9:] for n in notes_g] == [n[:7] + n[9:] for n in notes_s], "The writers give different notes"
+
+
+def run(writer: str, notes: Dict, num_notes: int, repeats: int, tmp: Path) -> Dict:
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        jupyter_to_anki.write_package(tmp / f"{writer}.apkg", notes, writer)
+        times.append(time.perf_counter() - t0)
+    result = {
+        "benchmark": f"write_package ({writer})",
+        "size": num_notes,
+        "times_s": times,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "us_per_item": 1e6 * min(times) / num_notes,
+    }
+    print(f"{result['benchmark']:<30} {num_notes:>8} {1000 * result['min_s']:>12.1f} {result['us_per_item']:>10.1f}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the genanki and bulk SQLite package writers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="number of notes in each package")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-cells", type=int, default=500, help="number of distinct cards to render (they're repeated to make up the notes)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="where to write the results (as JSON)")
+    args = parser.parse_args()
+
+    results: List[Dict] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        os.environ["JUPYTER_TO_ANKI_MEDIA"] = str(tmp)
+        cards = rendered_cards(tmp, args.num_cells, args.seed)
+        check_writers_agree(make_notes(cards, min(args.sizes)), tmp)
+
+        print(f"{'benchmark':<30} {'notes':>8} {'min (ms)':>12} {'us/note':>10}")
+        for num_notes in args.sizes:
+            notes = make_notes(cards, num_notes)
+            by_writer = {writer: run(writer, notes, num_notes, args.repeats, tmp) for writer in WRITERS}
+            print(f"{'speedup':<30} {num_notes:>8} {by_writer['genanki']['min_s'] / by_writer['sqlite']['min_s']:>11.1f}x")
+            results += by_writer.values()
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"\nWrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
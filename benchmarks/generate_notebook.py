@@ -0,0 +1,159 @@
+"""
+Generator for synthetic notebooks, used by the benchmarks (they run offline, so they can't use real notebooks).
+
+The notebooks look like the template notebook: a cell which calls `write_cards_to_anki_package`, DECK / TAGS cells, and
+markdown cells with cards made of text, lists, codeblocks, quoteboxes, input fields and images. You can also run this on
+its own to write a notebook, e.g.
+
+    python benchmarks/generate_notebook.py synthetic.ipynb --num-cells 1000 --num-attachments 2 --attachment-size 20000
+"""
+import argparse
+import base64
+import json
+import random
+from typing import Dict, List
+
+WORDS = ["the", "of", "a", "model", "layer", "attention", "gradient", "loss", "tensor", "matrix", "vector", "token",
+         "embedding", "function", "returns", "value", "input", "output", "weights", "bias", "is", "and", "with", "for"]
+INLINE_MARKDOWN = ["**{}**", "*{}*", "`{}`", "(S){}(S)", "\\({}^2\\)"]
+CODE_LINES = ["def f(x, y):", "    return x @ y", "x = t.zeros(10)", ">>> f(a, b)", "for i in range(10):", "    print(i)"]
+
+
+def text_line(r: random.Random, input_density: float) -> str:
+    words = [r.choice(WORDS) for _ in range(r.randint(6, 20))]
+    # some words get inline markdown (bold, italic, code font, spoilers, LaTeX)
+    for i in r.sample(range(len(words)), k=len(words) // 5):
+        words[i] = r.choice(INLINE_MARKDOWN).format(words[i])
+    if r.random() < input_density:
+        words.append("{{{" + r.choice(WORDS) + "}}}")
+    return " ".join(words).capitalize() + "."
+
+
+def field(
+    r: random.Random,
+    attachments: List[str],
+    list_density: float,
+    codeblock_density: float,
+    quotebox_density: float,
+    input_density: float,
+) -> List[str]:
+    """
+    Returns the lines of a single field (blocks are separated by empty lines, as they should be in a card)
+    """
+    blocks = [[text_line(r, input_density)]]
+    for _ in range(r.randint(0, 4)):
+        k = r.random()
+        if k < list_density:
+            bullet = r.choice(["* ", "{}. "])
+            blocks.append([bullet.format(i + 1) + text_line(r, input_density) for i in range(r.randint(2, 5))])
+        elif k < list_density + codeblock_density:
+            lines = ["    " + r.choice(CODE_LINES) for _ in range(r.randint(2, 8))]
+            if r.random() < input_density:
+                lines.append("    {{{" + r.choice(WORDS) + "}}}")
+            blocks.append(lines)
+        elif k < list_density + codeblock_density + quotebox_density:
+            blocks.append(["(Q)", text_line(r, 0), text_line(r, 0), "(Q)", " ".join(r.choice(WORDS) for _ in range(3)), "(Q)"])
+        else:
+            blocks.append([text_line(r, input_density)])
+    for name in attachments:
+        blocks.insert(r.randint(1, len(blocks)), [f"![{name}](attachment:{name})"])
+    return [line for block in blocks for line in block + [""]][:-1]
+
+
+def generate_notebook(
+    num_cells: int = 100,
+    card_types: List[str] = ["front", "front-back", "image"],
+    hint_fraction: float = 0.3,
+    list_density: float = 0.2,
+    codeblock_density: float = 0.2,
+    quotebox_density: float = 0.1,
+    input_density: float = 0.1,
+    num_attachments: int = 0,
+    attachment_size: int = 10000,
+    num_decks: int = 3,
+    seed: int = 0,
+) -> Dict:
+    """
+    Returns a notebook (as a dict in the nbformat structure) containing `num_cells` cards.
+
+    Arguments are:
+        card_types
+            the card types to use (each card gets one at random)
+        hint_fraction
+            fraction of cards which have a hint (`-h` separator)
+        list_density, codeblock_density, quotebox_density
+            probability that each block of a field (after the first) is a list / codeblock / quotebox
+        input_density
+            probability that each line of text or codeblock gets an input field, `{{{...}}}` (not used in image cards)
+        num_attachments, attachment_size
+            number of images attached to each cell, and the size of each one in bytes (before base64 encoding)
+        num_decks
+            cards are spread over this many decks (with a DECK cell every time it changes)
+    """
+    r = random.Random(seed)
+    cells = []
+
+    def add_cell(cell_type: str, lines: List[str], attachments: Dict = None):
+        cell = {"cell_type": cell_type, "id": f"{r.getrandbits(32):08x}", "metadata": {}, "source": [line + "\n" for line in lines[:-1]] + lines[-1:]}
+        if cell_type == "code":
+            cell.update(execution_count=None, outputs=[])
+        if attachments:
+            cell["attachments"] = attachments
+        cells.append(cell)
+
+    add_cell("code", ["from jupyter_to_anki import write_cards_to_anki_package", "", "write_cards_to_anki_package(\"synthetic.ipynb\")"])
+    add_cell("markdown", ["TAGS = benchmark synthetic::cards"])
+    deck = None
+    for i in range(num_cells):
+        new_deck = f"Deck{i * num_decks // num_cells}"
+        if new_deck != deck:
+            deck = new_deck
+            add_cell("markdown", [f"DECK = {deck}"])
+
+        card_type = r.choice(card_types)
+        attachments = {}
+        for j in range(num_attachments):
+            data = base64.b64encode(r.getrandbits(8 * attachment_size).to_bytes(attachment_size, "little")).decode()
+            attachments[f"image-{j}.png"] = {"image/png": data}
+        names = list(attachments)
+        densities = (list_density, codeblock_density, quotebox_density, 0 if card_type == "image" else input_density)
+
+        # the images go on the back of the card (if it has one)
+        has_back = card_type != "front"
+        lines = field(r, [] if has_back else names, *densities)
+        if has_back:
+            lines += ["", "-" if card_type == "front-back" else "-i", ""] + field(r, names, *densities)
+        if r.random() < hint_fraction:
+            lines += ["", "-h", ""] + field(r, [], *densities)
+        add_cell("markdown", lines, attachments)
+
+    return {
+        "cells": cells,
+        "metadata": {"kernelspec": {"display_name": "Python 3", "language": "python", "name": "python3"}},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic notebook.")
+    parser.add_argument("filename")
+    parser.add_argument("--num-cells", type=int, default=100)
+    parser.add_argument("--card-types", nargs="+", default=["front", "front-back", "image"])
+    parser.add_argument("--hint-fraction", type=float, default=0.3)
+    parser.add_argument("--list-density", type=float, default=0.2)
+    parser.add_argument("--codeblock-density", type=float, default=0.2)
+    parser.add_argument("--quotebox-density", type=float, default=0.1)
+    parser.add_argument("--input-density", type=float, default=0.1)
+    parser.add_argument("--num-attachments", type=int, default=0)
+    parser.add_argument("--attachment-size", type=int, default=10000)
+    parser.add_argument("--num-decks", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = vars(parser.parse_args())
+    filename = args.pop("filename")
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(generate_notebook(**args), f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Benchmark suite for `jupyter_to_anki`, run on synthetic notebooks (see `generate_notebook.py`).
+
+Run from the root of the repo with:
+
+    python benchmarks/run_benchmarks.py --output results.json [--sizes 100 500 2000] [--compare old_results.json]
+
+For each notebook size (number of cards), this times:
+    read_cards                          reading and rendering the whole notebook (writing images to an empty media folder)
+    read_cards (num_cells_below=5)      the same, for the first 5 cards only (after the first repeat, the cell index is used)
+    write_cards_to_anki_package         the same, plus writing the anki packages
+    read_single_field                   rendering every field of every card
+    markdown_to_html_ignoring_codeblock the inline markdown of every line of text
+    build_image_line                    every image line (writing images to an empty media folder, and waiting for them)
+    lint_notebook                       checking the cards in the notebook, without rendering them
+
+It also times `read_single_field` on single fields with thousands of lines, and the block compiler it uses against the
+reference implementation (the time per line should stay roughly constant as the field gets longer, i.e. linear scaling).
+
+Everything runs offline, in a temporary directory (which is used in place of the `collections.media` folder). The
+results are written as JSON, so they can be compared across commits with `--compare`.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import jupyter_to_anki
+from generate_notebook import generate_notebook
+
+# one "unit" of a long field, containing each kind of block (10 lines)
+UNIT = [
+    "Some text with **bold** and *italic* and `code font`.",
+    "",
+    "* first point",
+    "* second point",
+    "",
+    "1. first item",
+    "2. second item",
+    "",
+    "    x = {{{1}}}",
+    "",
+]
+QUOTEBOX = ["(Q)", "A quote.", "(Q)", "The source.", "(Q)", ""]
+
+
+def make_long_field(num_lines: int) -> List[str]:
+    field = []
+    while len(field) < num_lines:
+        field += UNIT + (QUOTEBOX if len(field) % 50 == 0 else [])
+    return field[:num_lines]
+
+
+def split_fields(card: List[str]) -> List[List[str]]:
+    """
+    Splits the lines of a card into its fields (i.e. at the separators)
+    """
+    fields = [[]]
+    for line in card:
+        if line.strip() in ["-", "-i", "-h"]:
+            fields.append([])
+        else:
+            fields[-1].append(line)
+    for field in fields:
+        while field and field[0] == "":
+            field.pop(0)
+        while field and field[-1] == "":
+            field.pop()
+    return fields
+
+
+def is_text_line(line: str) -> bool:
+    return len(line) > 0 and not line.startswith(("    ", "* ", "(Q)", "![")) and not line[0].isdigit()
+
+
+def run(name: str, size: int, f: Callable, num_items: int, repeats: int, setup: Callable = None) -> Dict:
+    """
+    Times `f` (calling `setup` before each repeat, untimed), and returns the result as a dict
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            f()
+        times.append(time.perf_counter() - t0)
+    result = {
+        "benchmark": name,
+        "size": size,
+        "num_items": num_items,
+        "times_s": times,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "us_per_item": 1e6 * min(times) / max(num_items, 1),
+    }
+    print(f"{name:<40} {size:>7} {1000 * result['min_s']:>12.1f} {result['us_per_item']:>12.1f}")
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_image_lines(image_lines: List) -> None:
+    for line, images_dict in image_lines:
+        jupyter_to_anki.build_image_line(line, images_dict)
+    # images are written in the background, so we wait for them to finish
+    jupyter_to_anki.get_media_store().wait()
+
+
+def notebook_benchmarks(tmp: Path, num_cells: int, notebook_kwargs: Dict, repeats: int) -> List[Dict]:
+    filename = tmp / f"synthetic_{num_cells}.ipynb"
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(generate_notebook(num_cells=num_cells, **notebook_kwargs), f, indent=1)
+
+    # every repeat which writes images gets a new (empty) media folder
+    media_folders = iter(tmp / f"media_{num_cells}_{i}" for i in range(10 ** 6))
+    def new_media_folder():
+        path = next(media_folders)
+        path.mkdir()
+        os.environ["JUPYTER_TO_ANKI_MEDIA"] = str(path)
+
+    # the cards, fields, text lines and image lines of the notebook
+    with open(filename, encoding="utf-8") as f:
+        cells = json.load(f)["cells"]
+    cards = [
+        ([line.rstrip("\n") for line in cell["source"]], cell.get("attachments", {}))
+        for cell in cells if cell["cell_type"] == "markdown" and not cell["source"][0].startswith(("DECK", "TAGS"))
+    ]
+    fields = [(field, images_dict) for card, images_dict in cards for field in split_fields(card)]
+    text_lines = [line for field, _ in fields for line in field if is_text_line(line)]
+    image_lines = [(line, images_dict) for field, images_dict in fields for line in field if line.startswith("![")]
+
+    results = []
+    results.append(run(
+        "read_cards", num_cells, lambda: jupyter_to_anki.read_cards(str(filename), True, None),
+        len(cards), repeats, setup=new_media_folder,
+    ))
+    results.append(run(
+        "read_cards (num_cells_below=5)", num_cells, lambda: jupyter_to_anki.read_cards(str(filename), True, 5),
+        5, repeats, setup=new_media_folder,
+    ))
+    results.append(run(
+        "write_cards_to_anki_package", num_cells,
+        lambda: jupyter_to_anki.write_cards_to_anki_package(str(filename), filename_write=str(tmp / "synthetic.apkg"), overwrite=True),
+        len(cards), repeats, setup=new_media_folder,
+    ))
+    results.append(run(
+        "read_single_field", num_cells, lambda: [jupyter_to_anki.read_single_field(field, images_dict) for field, images_dict in fields],
+        len(fields), repeats,
+    ))
+    results.append(run(
+        "markdown_to_html_ignoring_codeblock", num_cells, lambda: [jupyter_to_anki.markdown_to_html_ignoring_codeblock(line) for line in text_lines],
+        len(text_lines), repeats,
+    ))
+    results.append(run(
+        "build_image_line", num_cells, lambda: write_image_lines(image_lines),
+        len(image_lines), repeats, setup=new_media_folder,
+    ))
+    results.append(run(
+        "lint_notebook", num_cells, lambda: jupyter_to_anki.lint_notebook(filename),
+        len(cards), repeats,
+    ))
+    return results
+
+
+def long_field_benchmarks(num_lines: int, repeats: int) -> List[Dict]:
+    field = make_long_field(num_lines)
+    assert jupyter_to_anki.compile_blocks(field, {}) == jupyter_to_anki.compile_blocks_reference(field, {})
+    return [
+        run("read_single_field (long field)", num_lines, lambda: jupyter_to_anki.read_single_field(field, {}), num_lines, repeats),
+        run("compile_blocks (long field)", num_lines, lambda: jupyter_to_anki.compile_blocks(field, {}), num_lines, repeats),
+        run("compile_blocks_reference (long field)", num_lines, lambda: jupyter_to_anki.compile_blocks_reference(field, {}), num_lines, repeats),
+    ]
+
+
+def compare(results: List[Dict], filename_old: str):
+    with open(filename_old, encoding="utf-8") as f:
+        old = {(r["benchmark"], r["size"]): r for r in json.load(f)["results"]}
+    print(f"\nComparison with {filename_old} (ratio < 1 means faster now):\n")
+    print(f"{'benchmark':<40} {'size':>7} {'old (ms)':>12} {'new (ms)':>12} {'ratio':>8}")
+    for r in results:
+        r_old = old.get((r["benchmark"], r["size"]))
+        if r_old is not None:
+            print(f"{r['benchmark']:<40} {r['size']:>7} {1000 * r_old['min_s']:>12.1f} {1000 * r['min_s']:>12.1f} {r['min_s'] / r_old['min_s']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmarks on synthetic notebooks.")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--compare", default=None, help="results from an earlier run, to compare against")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 2000], help="number of cards in each notebook")
+    parser.add_argument("--field-sizes", type=int, nargs="+", default=[1000, 4000, 16000], help="number of lines in each long field")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-attachments", type=int, default=1, help="images per card")
+    parser.add_argument("--attachment-size", type=int, default=5000, help="size of each image, in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    notebook_kwargs = {"num_attachments": args.num_attachments, "attachment_size": args.attachment_size, "seed": args.seed}
+    results = []
+    print(f"{'benchmark':<40} {'size':>7} {'min (ms)':>12} {'us/item':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["JUPYTER_TO_ANKI_MEDIA"] = str(Path(tmp) / "media")
+        (Path(tmp) / "media").mkdir()
+        for num_cells in args.sizes:
+            results += notebook_benchmarks(Path(tmp), num_cells, notebook_kwargs, args.repeats)
+        for num_lines in args.field_sizes:
+            results += long_field_benchmarks(num_lines, args.repeats)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "args": vars(args),
+            },
+            "results": results,
+        }, f, indent=2)
+    print(f"\nWrote results to {args.output}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
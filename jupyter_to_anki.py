@@ -1,264 +1,2182 @@
 from __future__ import unicode_literals
 from pathlib import Path
 import re
-from collections import defaultdict
-from bs4 import BeautifulSoup
+from collections import defaultdict, deque
+import contextlib
 import json
 import base64
+import codecs
+import os
 import hashlib
-from typing import List, Dict, Tuple, Optional, Union
-import traceback
-import genanki
-import hashlib
+import io
+import itertools
+import queue
+import struct
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import List, Dict, Tuple, Optional, Union, Callable, NamedTuple, TYPE_CHECKING
+
+# bs4, genanki, concurrent.futures, traceback, html and sqlite3 are slow to import, so they're imported inside the
+# functions which use them (this keeps importing this module fast, which matters for the command line and for worker
+# processes), and only imported here for type checkers and linters
+if TYPE_CHECKING:
+    import argparse
+    from bs4 import BeautifulSoup
+    import genanki
+    import sqlite3
+
+# The folder your images get written to (Anki's `collection.media` folder). You can set it here, or see `get_p_media`
+p_media = Path("")
+
+# Config file which can be used to set the media folder, e.g. {"p_media": "C:/Users/.../collection.media"}
+CONFIG_PATH = Path.home() / ".jupyter_to_anki.json"
+
+# The media folder passed as an argument to the function currently running, if there is one
+p_media_arg = None
+
+# The image optimiser used by the function currently running, if images are being optimised (see `ImageOptimizer`)
+image_optimizer_arg = None
+
+@lru_cache(maxsize=None)
+def read_config(path: Path = CONFIG_PATH) -> Dict:
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def get_p_media() -> Path:
+    """
+    Returns the media folder. In order of priority, this comes from:
+        * the `p_media` argument of `write_cards_to_anki_package` (or `--media` on the command line)
+        * `p_media` at the top of this file, if you've changed it
+        * the JUPYTER_TO_ANKI_MEDIA environment variable
+        * the "p_media" key in the config file `~/.jupyter_to_anki.json`
+    """
+    return resolve_p_media(p_media_arg, p_media, os.environ.get("JUPYTER_TO_ANKI_MEDIA"))
+
+@lru_cache(maxsize=None)
+def resolve_p_media(p_media_arg, p_media, p_media_env) -> Path:
+    # this is called for every card, so the result is memoized
+    if p_media_arg is not None:
+        return Path(p_media_arg)
+    for path in [p_media, p_media_env, read_config().get("p_media")]:
+        if path is not None and len(Path(path).anchor) > 0:
+            return Path(path)
+    raise AssertionError("You need to set the media folder (`p_media`), either in the Python file you downloaded, with the JUPYTER_TO_ANKI_MEDIA environment variable, or in the config file ~/.jupyter_to_anki.json. See the GitHub instructions for more.")
+
+@lru_cache(maxsize=None)
+def get_templates_dict() -> Dict:
+    """
+    Returns the dictionary of card templates (read from the files the first time this is called)
+    """
+    templates_dict = defaultdict(dict)
+    for card_type in ["front", "front-back", "image"]:
+        for group in ["front", "back", "css"]:
+            with open(Path(__file__).parent / f"templates/{card_type}-{group[0]}.txt", encoding="utf-8") as f:
+                templates_dict[card_type][group] = f.read()
+    return templates_dict
+
+@lru_cache(maxsize=None)
+def get_templates_hash() -> str:
+    return hashlib.sha256(json.dumps(get_templates_dict(), sort_keys=True).encode()).hexdigest()
+
+### MISC FUNCTIONS
+
+def load_json_with_header(path: Path, header: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Loads one of the JSON files we keep next to notebooks and packages (caches, indices and manifests). Returns None if it
+    doesn't exist, can't be read, or was saved with a different header (e.g. by an older version of this code), in which
+    case it's just rebuilt from scratch.
+    """
+    if not path.exists():
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or (header is not None and data.get("header") != header):
+        return None
+    return data
+
+def write_json_atomic(path: Path, data: Dict) -> None:
+    """
+    Writes to a temporary file first, so an interrupted run can't leave a half-written file behind
+    """
+    path_tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(path_tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    path_tmp.replace(path)
+
+def encode_str(s):
+    return int(hashlib.sha256(bytes(s, encoding="utf-8")).hexdigest(), 16) % (10 ** 10)
+
+def get_filename_from_json_data(json_data, filetype="jpg", key=""):
+    # `key` is for anything else which changes the file (e.g. the settings it was optimised with)
+    h = hashlib.sha256(bytes(json_data, "utf-8"))
+    h.update(bytes(key, "utf-8"))
+    return h.hexdigest() + "." + filetype
+
+def get_random_seed_for_inputs(i_value, increment):
+    """
+    Generates a random seed for use in the Anki input field.
+    
+    Note that the purpose of "increment" is to make sure the same field showing up twice doesn't lead to the same random seed
+    """
+    h = hashlib.sha256(bytes(i_value + str(increment), "utf-8")).hexdigest()
+    h = "".join([ch for ch in h if ch.isdigit()])
+    return f"{int(h[:8]):08d}"
+
+# what Anki removes from a field to get the text it sorts and checksums notes by (see `strip_html_media`)
+HTML_IMG_REGEX = re.compile("<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>", re.IGNORECASE)
+HTML_STRIP_REGEX = re.compile("<!--.*?-->|<style.*?>.*?</style>|<script.*?>.*?</script>|<.*?>", re.IGNORECASE | re.DOTALL)
+# most fields don't have any of these, so only their tags need removing (which is quicker)
+HTML_SPECIAL_REGEX = re.compile("<!--|<style|<script|<img", re.IGNORECASE)
+HTML_TAG_REGEX = re.compile("<[^>]*>")
+
+def strip_html_media(s: str) -> str:
+    """
+    Returns the text of a field, with HTML removed and images replaced by their filenames (same as `stripHTMLMedia` in Anki)
+    """
+    import html
+    if "<" in s:
+        if HTML_SPECIAL_REGEX.search(s):
+            s = HTML_STRIP_REGEX.sub("", HTML_IMG_REGEX.sub(" \\1 ", s))
+        else:
+            s = HTML_TAG_REGEX.sub("", s)
+    return html.unescape(s.replace("&nbsp;", " ")) if "&" in s else s
+
+def field_checksum(text: str) -> int:
+    """
+    Anki's checksum of a field (the first 8 hex digits of the SHA1 of its text, i.e. after `strip_html_media`), which it
+    uses to find duplicate notes
+    """
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+
+def get_card_type_and_hint(card) -> Tuple[str, int, int, int]:
+    """
+    Figures out whether it's a front or front-back or image card, based on whether it contains a `-` or `-i` separator.
+
+    Also figures out whether it's got a hint, based on whether it contains a `-h` separator.
+    """
+
+    all_separators = [c.strip() for c in card if c.strip().startswith("-")]
+    assert len(all_separators) <= 2, f"There should be at most separators (lines starting with '-'), instead we found {len(all_separators)} in one of your cards.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+    bad_separators = [sep for sep in all_separators if sep not in ["-", "-h", "-i"]]
+    assert len(bad_separators) == 0, f"The only allowed separators (lines starting with '-') are '-' (for front/back), '-i' (for image cards) and '-h' (for hints). Instead we found the separators {bad_separators} in one of your cards.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+    
+    separators = [(i, c.strip()) for i, c in enumerate(card) if c.strip() in ["-", "-i", "-h"]]
+    if "-" in all_separators:
+        fb_separator, img_separator = min([i for i, c in separators if c == "-"]), 0
+        card_type = "front-back"
+    elif "-i" in all_separators:
+        fb_separator, img_separator = 0, min([i for i, c in separators if c == "-i"])
+        card_type = "image"
+    else:
+        fb_separator, img_separator = 0, 0
+        card_type = "front"
+
+    hint_separator = min([i for i, c in separators if c == "-h"]) if ("-h" in all_separators) else 0
+
+    return (card_type, fb_separator, img_separator, hint_separator)
+
+
+### NOTEBOOK READING
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE_REGEX = re.compile("[ \t\n\r]*")
+# characters which the HTML parser might read as the start of a tag or an entity (e.g. "<b>", "</b>", "&amp;" or "&#62;")
+HTML_MARKUP_START_REGEX = re.compile("<[a-zA-Z/!?]|&[#a-zA-Z]")
+
+def clean_html_text(s: str) -> str:
+    """
+    Removes stray HTML from a string in the notebook, giving the same result as the BeautifulSoup pass which used to be
+    run over the whole notebook (i.e. tags are removed, and `&`, `<` and `>` come out as HTML entities).
+
+    Most strings (including all base64 image data) don't contain any of these characters, so they're returned unchanged.
+    """
+    if HTML_MARKUP_START_REGEX.search(s):
+        return parse_html_string(parse_html_string(s).text).decode_contents()
+    if "&" in s or "<" in s or ">" in s:
+        return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return s
+
+
+def parse_html_string(s: str) -> "BeautifulSoup":
+    """
+    Parses a string from the notebook as HTML, the way the parser used to see it when it was run over the whole notebook,
+    i.e. between the quotes which start and end the string in the notebook's JSON (without these, things like a trailing
+    "&b" get read as an unfinished entity and dropped, and leading whitespace on its own gets collapsed).
+
+    The quotes are then taken back out of the soup. The first one is always the first character of the first string in
+    the soup, and the last one is the last character of the last string, unless the string ended inside something which
+    swallowed it (e.g. an unclosed <script> or <style>), in which case there's nothing to take out.
+    """
+    from bs4 import BeautifulSoup, NavigableString
+    soup = BeautifulSoup('"' + s + '"', "html.parser")
+    for i, strip in [(-1, lambda string: string[:-1]), (0, lambda string: string[1:])]:
+        leaf = soup
+        while getattr(leaf, "contents", None):
+            leaf = leaf.contents[i]
+        if type(leaf) is NavigableString and leaf[i] == '"':
+            if len(leaf) == 1:
+                leaf.extract()
+            else:
+                leaf.replace_with(NavigableString(strip(leaf)))
+    return soup
+
+
+class NotebookCellStream:
+    """
+    Reads the cells of a notebook one at a time, without ever holding much more than one cell's JSON in memory.
+
+    The file is read (and decoded) in chunks, and each cell is decoded straight out of the buffer with the C JSON decoder,
+    then dropped from the buffer. If a cell doesn't fit in the buffer yet, the decoder fails and we read more (doubling the
+    amount each time, so very large cells still only get decoded a few times).
+    """
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.offset = 0     # byte offset (in the file) of self.buf[0]
+        self.eof = False
+
+    def fill(self, size: Optional[int] = None) -> None:
+        if self.eof:
+            raise json.JSONDecodeError("Notebook ended unexpectedly", self.buf, len(self.buf))
+        chunk = self.f.read(size or self.chunk_size)
+        self.eof = not chunk
+        self.buf += self.decoder.decode(chunk, final=self.eof)
+
+    @staticmethod
+    def num_bytes(s: str) -> int:
+        return len(s) if s.isascii() else len(s.encode("utf-8"))
+
+    def drop(self, i: int) -> int:
+        """Drops everything before index i of the buffer (we never need to look back at it), returns the new index"""
+        self.offset += self.num_bytes(self.buf[:i])
+        self.buf = self.buf[i:]
+        return 0
+
+    def skip_whitespace(self, i: int) -> int:
+        while True:
+            i = JSON_WHITESPACE_REGEX.match(self.buf, i).end()
+            if i < len(self.buf):
+                return i
+            self.fill()
+
+    def expect(self, i: int, chars: str) -> Tuple[int, str]:
+        i = self.skip_whitespace(i)
+        c = self.buf[i]
+        if c not in chars:
+            # same message as `json.loads` gives (`read_cards` looks for it, to give advice about the error)
+            raise json.JSONDecodeError("Expecting ',' delimiter" if "," in chars else f"Expecting {chars!r}", self.buf, i)
+        return i + 1, c
+
+    def decode_value(self, i: int) -> Tuple[object, int]:
+        """Given i is the first character of a JSON value, returns (value, index just after the value ends)"""
+        size = self.chunk_size
+        while True:
+            try:
+                value, j = JSON_DECODER.raw_decode(self.buf, i)
+                # a number at the end of the buffer might be cut off, so we need to see what comes after it
+                if j < len(self.buf) or self.eof:
+                    return value, j
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(size)
+            size *= 2
+
+    def __iter__(self):
+        """
+        Yields (start, end, cell_dict) for every cell, where start and end are the byte offsets of the cell in the file
+        """
+        head = self.f.read(3)
+        if head == codecs.BOM_UTF8:
+            self.offset = 3
+        else:
+            self.buf = self.decoder.decode(head)
+        i = self.skip_whitespace(0)
+        i, _ = self.expect(i, "{")
+        while True:
+            i = self.drop(self.skip_whitespace(i))
+            if self.buf[0] == "}":
+                raise json.JSONDecodeError("Notebook doesn't have a 'cells' key", self.buf, 0)
+            key, i = self.decode_value(i)
+            i, _ = self.expect(i, ":")
+            i = self.skip_whitespace(i)
+            if key != "cells":
+                i, c = self.expect(self.decode_value(i)[1], ",}")
+                if c == "}":
+                    raise json.JSONDecodeError("Notebook doesn't have a 'cells' key", self.buf, i)
+                continue
+            i, _ = self.expect(i, "[")
+            yield from self.iter_cells(i)
+            return
+
+    def iter_cells(self, i: int):
+        """
+        Yields (start, end, cell_dict) for every cell in the list of cells, from index i of the buffer to the end of the list
+        """
+        i = self.skip_whitespace(i)
+        if self.buf[i] == "]":
+            return
+        while True:
+            i = self.drop(self.skip_whitespace(i))
+            cell_dict, j = self.decode_value(i)
+            yield self.offset, self.offset + self.num_bytes(self.buf[:j]), cell_dict
+            i, c = self.expect(j, ",]")
+            if c == "]":
+                return
+
+    def iter_from(self, offset: int):
+        """
+        Like iterating over the stream, but starting from the cell at byte `offset` of the file (e.g. one which was recorded
+        by `CellIndex`), rather than the first cell
+        """
+        self.f.seek(offset)
+        self.offset = offset
+        return self.iter_cells(0)
+
+
+def iter_notebook_cells(filename: str, chunk_size: int = 1 << 16):
+    """
+    Yields (index, cell_dict) for each cell in the notebook, reading the file one cell at a time.
+
+    Strings which could end up in a card are cleaned of stray HTML (see `clean_html_text`). To keep memory down, code cell
+    outputs are thrown away, and markdown cells only keep their attachments if they contain an image line which could
+    reference them (the base64 data isn't decoded until `build_image_line` needs it).
+    """
+    with open(filename, "rb") as f:
+        for i, (_, _, cell_dict) in enumerate(NotebookCellStream(f, chunk_size)):
+            yield i, clean_notebook_cell(cell_dict)
+
+
+def clean_notebook_cell(cell_dict: Dict) -> Dict:
+    """
+    The parts of a cell (as it is in the notebook's JSON) which we need, as described in `iter_notebook_cells`
+    """
+    source = cell_dict.get("source", [])
+    source = clean_html_text(source) if isinstance(source, str) else [clean_html_text(line) for line in source]
+    cell = {"cell_type": cell_dict.get("cell_type"), "id": cell_dict.get("id"), "source": source}
+    if cell["cell_type"] == "markdown":
+        attachments = cell_dict.get("attachments", {})
+        if attachments and any("![" in line for line in source):
+            cell["attachments"] = {clean_html_text(k): v for k, v in attachments.items()}
+        else:
+            cell["attachments"] = {}
+    return cell
+
+
+### CELL INDEX
+
+# bump this whenever a change to the code means cells would be indexed differently (it invalidates all cell indexes)
+CELL_INDEX_VERSION = 1
+# what comes after a cell in the notebook: either "]" (the end of the list of cells), or "," and then whitespace
+CELL_SEPARATOR_REGEX = re.compile(b"[ \t\n\r]*(?:(\\])|,[ \t\n\r]*)")
+
+class CellIndex:
+    """
+    Index of the cells in a notebook, kept next to it, so that partial exports (i.e. when `num_cells_below` isn't None)
+    only have to read the cells they turn into cards, rather than the whole notebook.
+
+    For each cell, this records its byte offsets in the file, its id, a hash of its bytes, what kind of cell it is (see
+    `cell_kind`), and a snapshot of the DECK / TAGS / URL in effect at that cell. When the notebook has changed, the index
+    is refreshed incrementally: the cells whose bytes haven't changed (usually almost all of them, even if they've moved)
+    are only hashed, and only the cells which were added or edited are decoded.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.header = {"version": CELL_INDEX_VERSION}
+        # size and modification time of the notebook when the index was last refreshed
+        self.stat = None
+        # byte offset of the first cell, and hash of everything before it
+        self.prefix = None
+        # [start, end, id, hash, kind, meta lines (only for "meta" cells), [deck, tags, url] in effect at this cell]
+        self.cells = []
+        self.changed = False
+        data = load_json_with_header(self.path, self.header)
+        if data is not None:
+            self.stat, self.prefix, self.cells = data["stat"], data["prefix"], data["cells"]
+
+    @staticmethod
+    def path_for(filename: Union[str, Path]) -> Path:
+        filename = Path(filename)
+        return filename.with_name(f".{filename.stem}_cells.json")
+
+    @staticmethod
+    def read_bytes(f, start: int, end: int) -> bytes:
+        f.seek(start)
+        return f.read(end - start)
+
+    @staticmethod
+    def next_cell_start(f, end: int) -> Optional[int]:
+        """
+        Byte offset of the cell after the one which ends at byte `end`, or None if it was the last cell
+        """
+        f.seek(end)
+        data = b""
+        while True:
+            chunk = f.read(256)
+            if not chunk:
+                raise json.JSONDecodeError("Notebook ended unexpectedly", data.decode("utf-8", "replace"), len(data))
+            data += chunk
+            m = CELL_SEPARATOR_REGEX.match(data)
+            if m is not None and (m.group(1) or m.end() < len(data)):
+                return None if m.group(1) else end + m.end()
+            if data.strip(b" \t\n\r,"):
+                # same message as `json.loads` gives (`read_cards` looks for it, to give advice about the error)
+                raise json.JSONDecodeError("Expecting ',' delimiter", data.decode("utf-8", "replace"), 0)
+
+    def refresh(self, filename: str) -> None:
+        """
+        Brings the index up to date with the notebook, if it's changed since the last time
+        """
+        stat = os.stat(filename)
+        stat = [stat.st_size, stat.st_mtime_ns]
+        if stat == self.stat:
+            return
+        sha1 = lambda data: hashlib.sha1(data).hexdigest()
+        with open(filename, "rb") as f, open(filename, "rb") as f_stream:
+            # if anything before the first cell has changed, we decode the whole notebook again (this also finds the first cell)
+            old_cells = []
+            if self.prefix is not None and sha1(self.read_bytes(f, 0, self.prefix[0])) == self.prefix[1]:
+                old_cells = self.cells
+            old_by_hash = {entry[3]: k for k, entry in enumerate(old_cells)}
+            start = self.prefix[0] if old_cells else None
+            stream = None if old_cells else iter(NotebookCellStream(f_stream))
+            cells, k = [], 0
+            while True:
+                # usually the next cell is the same as the next one in the old index, so we only need to hash it
+                if k < len(old_cells) and sha1(self.read_bytes(f, start, start + old_cells[k][1] - old_cells[k][0])) == old_cells[k][3]:
+                    entry, k, stream = old_cells[k], k + 1, None
+                # if it isn't, we decode it (carrying on from the cell before, if that was decoded too)
+                else:
+                    if stream is None:
+                        stream = NotebookCellStream(f_stream).iter_from(start)
+                    try:
+                        start, end, cell_dict = next(stream)
+                    except StopIteration:
+                        break
+                    h = sha1(self.read_bytes(f, start, end))
+                    # (it might still be in the old index, e.g. if the cells before it were deleted)
+                    if h in old_by_hash:
+                        entry, k = old_cells[old_by_hash[h]], old_by_hash[h] + 1
+                    else:
+                        cell = clean_notebook_cell(cell_dict)
+                        kind = cell_kind(cell)
+                        entry = [start, end, cell["id"], h, kind, [match_meta(line) for line in cell["source"]] if kind == "meta" else [], None]
+                cells.append([start, start + entry[1] - entry[0], *entry[2:]])
+                start = self.next_cell_start(f, cells[-1][1])
+                if start is None:
+                    break
+            self.prefix = [cells[0][0], sha1(self.read_bytes(f, 0, cells[0][0]))] if cells else None
+
+        # the snapshots of the meta state are worked out again from the start, since a meta cell changes all the ones after it
+        meta_dict = {"deck": "", "tags": "", "url": ""}
+        for entry in cells:
+            if entry[4] == "meta":
+                meta_dict.update(entry[5])
+            entry[6] = [meta_dict["deck"], meta_dict["tags"], meta_dict["url"]]
+        self.stat, self.cells, self.changed = stat, cells, True
+
+    def read_cell(self, f, i: int) -> Dict:
+        """
+        Reads cell i straight from the notebook (as `iter_notebook_cells` would give it)
+        """
+        start, end, _, h = self.cells[i][:4]
+        data = self.read_bytes(f, start, end)
+        if hashlib.sha1(data).hexdigest() != h:
+            raise Exception("The notebook was changed while its cards were being read. Try running this function again.")
+        return clean_notebook_cell(json.loads(data.decode("utf-8")))
+
+    def iter_card_cells(self, filename: str, num_cells_below: Union[int, str], timings: Optional[Dict[str, float]] = None):
+        """
+        Does the same as `iter_card_cells` for a partial export (i.e. num_cells_below is "all" or an integer), but only reads
+        the cells which are turned into cards. The index is refreshed (and saved) first. If `timings` is given, the time
+        spent reading the notebook is added to timings["load"].
+        """
+        timings = defaultdict(float) if timings is None else timings
+        t0 = time.perf_counter()
+        self.refresh(filename)
+        self.save()
+        timings["load"] += time.perf_counter() - t0
+
+        n = num_cells_below
+        num_call_cells, markdown_counter = 0, 0
+        guids, notebook_name = set(), Path(filename).name
+        with open(filename, "rb") as f:
+            for i, (_, _, _, _, kind, _, (deck, tags, url)) in enumerate(self.cells):
+                if kind == "call":
+                    num_call_cells += 1
+                # (once we've got all the cards we want, we still go through the rest of the cells, to check the code cells)
+                elif kind == "card" and not (isinstance(n, int) and markdown_counter == n):
+                    check_card_meta(deck, tags)
+                    if num_call_cells > 0:
+                        t0 = time.perf_counter()
+                        cell_dict = self.read_cell(f, i)
+                        timings["load"] += time.perf_counter() - t0
+                        yield deck, cell_dict["source"], cell_dict["attachments"], tags, url, card_guid(notebook_name, cell_dict, i, guids), i
+                        markdown_counter += 1
+
+        assert num_call_cells == 1, CALL_CELL_ERROR.format(num_call_cells)
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        write_json_atomic(self.path, {"header": self.header, "stat": self.stat, "prefix": self.prefix, "cells": self.cells})
+        self.changed = False
+
+
+### RENDER CACHE
+
+# bump this whenever a change to the code means the same cell would be rendered differently (it invalidates all caches)
+RENDERER_VERSION = 4
+
+class RenderCache:
+    """
+    On-disk cache of rendered cards, so cells which haven't changed since the last run don't get rendered again.
+
+    Keys are hashes of the cell source, its attachments, the DECK/TAGS/URL in effect and the image optimiser settings (since
+    these change the names of the images), and values are the card type,
+    the rendered fields and any error messages produced while rendering (so these still get printed on a cache hit).
+    The whole cache is thrown away if the renderer version or the templates have changed since it was written, and
+    when it has more than `max_entries` entries, the least recently used ones are evicted.
+    """
+    def __init__(self, path: Union[str, Path], max_entries: int = 20000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.header = {"renderer_version": RENDERER_VERSION, "templates": get_templates_hash()}
+        self.entries = {}
+        self.run = 0
+        self.changed = False
+        data = load_json_with_header(self.path, self.header)
+        if data is not None:
+            self.entries, self.run = data["entries"], data["run"]
+        self.run += 1
+
+    @staticmethod
+    def key(card: List[str], images_dict: Dict, deck: str, tags: str, url: str, image_optimizer: Optional["ImageOptimizer"] = None) -> str:
+        images_key = None if image_optimizer is None else image_optimizer.key
+        # the attachments are most of the cell, so their data is hashed as it is rather than being encoded as JSON (which
+        # is much slower), after their names, types and lengths (so the data of different attachments can't run together)
+        attachments = [(name, mime, data if isinstance(data, str) else json.dumps(data)) for name, mime_dict in sorted(images_dict.items()) for mime, data in sorted(mime_dict.items())]
+        h = hashlib.sha256(json.dumps([card, deck, tags, url, images_key, [(name, mime, len(data)) for name, mime, data in attachments]]).encode())
+        for _, _, data in attachments:
+            h.update(data.encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, List[str], List[str]]]:
+        """
+        Returns (card_type, fields, error messages) if the card is cached, else None.
+
+        A card also counts as a miss if one of the images it references has gone missing from the media folder since it was
+        rendered (so that rendering it again writes the image back).
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if not all(img_name in get_media_store() for img_name in entry["media"]):
+            return None
+        entry["used"] = self.run
+        return entry["card_type"], entry["fields"], entry["errors"]
+
+    def put(self, key: str, card_type: str, fields: List[str], errors: List[str]) -> None:
+        media = [img_name for field in fields for img_name in IMG_SRC_REGEX.findall(field)]
+        self.entries[key] = {"card_type": card_type, "fields": fields, "errors": errors, "media": media, "used": self.run}
+        self.changed = True
+
+    def save(self) -> None:
+        """
+        Writes the cache to disk, if any cards were added (if not, the updated "used" stamps are saved next time)
+        """
+        if not self.changed:
+            return
+        if len(self.entries) > self.max_entries:
+            keys = sorted(self.entries, key=lambda k: self.entries[k]["used"], reverse=True)[:self.max_entries]
+            self.entries = {k: self.entries[k] for k in keys}
+        write_json_atomic(self.path, {"header": self.header, "run": self.run, "entries": self.entries})
+
+
+### MEDIA STORE
+
+# file extensions for the image types Jupyter stores attachments as (anything else falls back to the attachment's name)
+MIME_FILETYPES = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp", "image/svg+xml": "svg", "image/bmp": "bmp"}
+# the images a rendered field refers to
+IMG_SRC_REGEX = re.compile("<img src='([^']*)'>")
+# image types which are already compressed, so they're stored in packages as they are (deflating them again is wasted time)
+PRECOMPRESSED_FILETYPES = {"jpg", "jpeg", "png", "gif", "webp"}
+
+class MediaWriter:
+    """
+    Runs functions (i.e. image writes) in background threads, so rendering doesn't have to wait for the disk.
+
+    The queue is bounded, so if the disk can't keep up then rendering waits, rather than holding every image in memory.
+    """
+    def __init__(self, num_threads: int = 4, max_queued: int = 64):
+        self.queue = queue.Queue(max_queued)
+        for _ in range(num_threads):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            f, args = self.queue.get()
+            try:
+                f(*args)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, f: Callable, *args) -> None:
+        self.queue.put((f, args))
+
+    def wait(self) -> None:
+        """Blocks until everything submitted so far has finished"""
+        self.queue.join()
+
+
+class MediaStore:
+    """
+    Content-addressed store for the images written to the media folder.
+
+    Images are named by the hash of their (base64) data, so an image which is already in the folder never needs to be
+    decoded or written again. To avoid checking the filesystem for every image, we keep a manifest of the images we've
+    written (hash -> filename, size, format) in `.jupyter_to_anki_media.json` inside the media folder. The manifest is
+    only checked against the folder (with a single directory listing) if the folder has changed since it was saved, or
+    since the last build in this process (see `refresh`), e.g. because Anki deleted unused images from it.
+    New files are written to a temporary file first and then renamed, so Anki never sees half-written images.
+
+    Images are decoded and written in the background (see `MediaWriter`): `add` only works out the filename. Call `wait`
+    to make sure everything has been written, which returns the images that couldn't be (filename -> error message).
+
+    If an image optimiser is being used, images are optimised before they're written (see `ImageOptimizer`). Their names
+    include the optimiser settings, so the media folder works as a cache of optimised images: each one is only optimised
+    once for the same settings.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path_manifest = self.path / ".jupyter_to_anki_media.json"
+        # the folder's mtime when the manifest was last checked against it, which is kept in a separate file (see `save`)
+        self.path_mtime = self.path / ".jupyter_to_anki_media_mtime.json"
+        self.manifest = {}
+        self.changed = False
+        data = load_json_with_header(self.path_manifest)
+        if data is not None:
+            self.manifest = data.get("images", {})
+        data = load_json_with_header(self.path_mtime)
+        self.folder_mtime = None if data is None else data.get("folder_mtime")
+        # total size of the images written by this process, and how much smaller optimising made them (for the build report)
+        self.bytes_written = 0
+        self.bytes_saved = 0
+        self.failures = {}
+        self.lock = threading.Lock()
+        # threads don't survive a fork, so worker processes need to start their own writer
+        self.writer, self.writer_pid = None, None
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Checks the manifest against the folder (with a single directory listing), if the folder has changed since it was
+        last checked. This is done at the start of every build, since the store lasts as long as the process (e.g. a
+        Jupyter kernel), and images can be deleted from the folder between builds.
+        """
+        self.wait()
+        folder_mtime = self.path.stat().st_mtime_ns
+        if folder_mtime != self.folder_mtime:
+            filenames = set(os.listdir(self.path))
+            manifest = {h: entry for h, entry in self.manifest.items() if entry["filename"] in filenames}
+            # (if the folder's mtime wasn't saved, the manifest is saved again so that it is)
+            if len(manifest) != len(self.manifest) or (self.folder_mtime is None and manifest):
+                self.manifest, self.changed = manifest, True
+            self.folder_mtime = folder_mtime
+        self.filenames = {entry["filename"] for entry in self.manifest.values()}
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.filenames or (self.path / filename).exists()
+
+    def add(self, img_code: str, filetype: str) -> str:
+        """
+        Makes sure the image with this base64 data is in the media folder, and returns its filename.
+        """
+        image_optimizer = image_optimizer_arg if image_optimizer_arg is not None and image_optimizer_arg.can_optimize(filetype) else None
+        # hash of the data (and optimiser settings), so it has a unique filename
+        if image_optimizer is None:
+            img_name_new = get_filename_from_json_data(img_code, filetype=filetype)
+        else:
+            img_name_new = get_filename_from_json_data(img_code, filetype=image_optimizer.filetype(filetype), key=image_optimizer.key)
+        if img_name_new in self.filenames:
+            return img_name_new
+        self.filenames.add(img_name_new)
+        if self.writer_pid != os.getpid():
+            self.writer, self.writer_pid = MediaWriter(), os.getpid()
+        self.writer.submit(self.write, img_code, img_name_new, filetype, image_optimizer)
+        return img_name_new
+
+    def write(self, img_code: str, img_name_new: str, filetype: str, image_optimizer: Optional["ImageOptimizer"] = None) -> None:
+        """
+        Writes an image, optimising it first if there's an optimiser (this runs in one of the writer's threads)
+        """
+        try:
+            # the manifest might be missing files which were written by another process, so we check before writing
+            path_img = self.path / img_name_new
+            if path_img.exists():
+                size, size_written, size_saved = path_img.stat().st_size, 0, 0
+            else:
+                img_bytes = base64.b64decode(img_code)
+                size_source = len(img_bytes)
+                if image_optimizer is not None:
+                    img_bytes = image_optimizer.optimize(img_bytes, filetype)
+                path_tmp = self.path / f".{img_name_new}.{os.getpid()}.tmp"
+                with open(path_tmp, "wb") as f:
+                    f.write(img_bytes)
+                path_tmp.replace(path_img)
+                size = size_written = len(img_bytes)
+                size_saved = size_source - size
+        except (OSError, ValueError) as e:
+            with self.lock:
+                self.filenames.discard(img_name_new)
+                self.failures[img_name_new] = f"{type(e).__name__}: {e}"
+            return
+        with self.lock:
+            self.manifest[img_name_new.split(".")[0]] = {"filename": img_name_new, "size": size, "format": img_name_new.split(".")[-1]}
+            self.bytes_written += size_written
+            self.bytes_saved += size_saved
+            self.failures.pop(img_name_new, None)
+            self.changed = True
+
+    def wait(self) -> Dict[str, str]:
+        """
+        Waits for all the images to be written, and returns the ones which couldn't be (filename -> error message)
+        """
+        if self.writer is not None and self.writer_pid == os.getpid():
+            self.writer.wait()
+        return self.failures
+
+    def save(self) -> None:
+        self.wait()
+        if not self.changed:
+            return
+        write_json_atomic(self.path_manifest, {"images": self.manifest})
+        # the folder's mtime is only known after the manifest has been written (which changes it), so it's saved in its
+        # own file afterwards. This is overwritten in place rather than replaced, since that doesn't change the folder's
+        # mtime (if it's only half-written, the mtime won't match next time, so the folder just gets listed again)
+        if not self.path_mtime.exists():
+            self.path_mtime.touch()
+        self.folder_mtime = self.path.stat().st_mtime_ns
+        with open(self.path_mtime, "w", encoding="utf-8") as f:
+            json.dump({"folder_mtime": self.folder_mtime}, f)
+        self.changed = False
+
+
+media_stores = {}
+
+def get_media_store() -> MediaStore:
+    """
+    Returns the media store for the media folder (there's one per process, so each image is only decoded once per run).
+    """
+    path = get_p_media()
+    if path not in media_stores:
+        media_stores[path] = MediaStore(path)
+    return media_stores[path]
+
+
+### MEDIA OPTIMISATION
+
+# magic bytes at the start of each image format (webp and svg are checked separately)
+IMAGE_SIGNATURES = [(b"\x89PNG\r\n\x1a\n", "png"), (b"\xff\xd8\xff", "jpg"), (b"GIF87a", "gif"), (b"GIF89a", "gif"), (b"BM", "bmp")]
+# formats the optimiser can write, and the name Pillow uses for each of them
+PILLOW_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+def sniff_filetype(img_code: str) -> Optional[str]:
+    """
+    Returns the format of an image from the magic bytes at the start of its (base64) data, or None if it isn't recognised.
+    Only the start of the data is decoded.
+    """
+    try:
+        head = base64.b64decode(img_code[:344])
+    except ValueError:
+        return None
+    for signature, filetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return filetype
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if b"<svg" in head:
+        return "svg"
+    return None
+
+
+class ImageOptimizer:
+    """
+    Optional stage which makes images smaller before they're written to the media folder (e.g. so full-resolution
+    screenshots don't bloat your collection, and slow down syncing).
+
+    Images which are bigger than `max_size` pixels (on their longest side) are scaled down, and then they're compressed
+    again, either in their own format or as `format` ("jpg", "png" or "webp") if it's given. `quality` is used for jpg and
+    webp. If an image in its own format doesn't come out any smaller, the original is kept. GIFs (which might be animated)
+    and SVGs are left alone.
+
+    This needs Pillow (`pip install pillow`). Optimised images are named by the hash of the original image and these
+    settings (see `MediaStore`), so each image is only optimised once.
+    """
+    def __init__(self, max_size: Optional[int] = 1600, quality: int = 85, format: Optional[str] = None):
+        assert format is None or format in PILLOW_FORMATS, f"Expected format to be one of {list(PILLOW_FORMATS)} or None, instead found {format!r}.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+        import importlib.util
+        if importlib.util.find_spec("PIL") is None:
+            raise ImportError("Optimising images needs Pillow, which you can install with `pip install pillow`.")
+        self.max_size = max_size
+        self.quality = quality
+        self.format = format
+        self.key = json.dumps([max_size, quality, format])
+
+    @classmethod
+    def from_arg(cls, optimize_images: Union[bool, Dict, "ImageOptimizer"]) -> Optional["ImageOptimizer"]:
+        """
+        Returns the optimiser for the `optimize_images` argument (False => None, True => default settings, dict => settings)
+        """
+        if isinstance(optimize_images, ImageOptimizer):
+            return optimize_images
+        if isinstance(optimize_images, dict):
+            return cls(**optimize_images)
+        return cls() if optimize_images else None
+
+    def can_optimize(self, filetype: str) -> bool:
+        return filetype in PILLOW_FORMATS or filetype == "bmp"
+
+    def filetype(self, filetype: str) -> str:
+        """
+        Returns the format an image of this format ends up as (bitmaps are always compressed, as png)
+        """
+        return self.format or ("png" if filetype == "bmp" else filetype)
+
+    def optimize(self, img_bytes: bytes, filetype: str) -> bytes:
+        from PIL import Image
+        filetype_new = self.filetype(filetype)
+        try:
+            with Image.open(io.BytesIO(img_bytes)) as img:
+                img.load()
+                resized = self.max_size is not None and max(img.size) > self.max_size
+                if resized:
+                    img.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+                # jpg doesn't do transparency, so transparent images go on a white background
+                if filetype_new == "jpg" and img.mode not in ["RGB", "L"]:
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, "white")
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                f = io.BytesIO()
+                options = {"optimize": True} if filetype_new != "webp" else {"method": 4}
+                if filetype_new in ["jpg", "webp"]:
+                    options["quality"] = self.quality
+                img.save(f, format=PILLOW_FORMATS[filetype_new], **options)
+        # Pillow can raise all sorts of things for images it can't read, in which case we write the original
+        except Exception:
+            return img_bytes
+        if filetype_new == filetype and not resized and len(f.getvalue()) >= len(img_bytes):
+            return img_bytes
+        return f.getvalue()
+
+
+### BUILD MANIFEST
+
+class BuildManifest:
+    """
+    Record of the notes in the last package we wrote (note GUID -> hash of its deck, type, fields and tags), so we can
+    find the notes which have been added or changed since then.
+
+    Notes have stable GUIDs (from the notebook name and the id of the cell they came from), so when you import a package
+    into Anki, notes which are already in your collection are updated rather than duplicated. This means a package only
+    needs to contain the notes which have changed ("delta" mode). Every note counts as changed if the templates have
+    changed, since Anki won't update a note type otherwise.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.header = {"templates": get_templates_hash()}
+        self.notes = {}
+        data = load_json_with_header(self.path, self.header)
+        if data is not None:
+            self.notes = data["notes"]
+
+    @staticmethod
+    def path_for(filename_write: Union[str, Path]) -> Path:
+        filename_write = Path(filename_write)
+        return filename_write.with_name(f".{filename_write.stem}_manifest.json")
+
+    def filter(self, cards, delta: bool = False):
+        """
+        Records a stream of (deck, card_type, fields, tags, guid) notes in the manifest, and yields them (or if delta=True,
+        only the ones which were added or changed)
+        """
+        for deck, card_type, fields, tags, guid in cards:
+            h = hashlib.sha256(json.dumps([deck, card_type, fields, tags]).encode()).hexdigest()
+            if not delta or self.notes.get(guid) != h:
+                yield deck, card_type, fields, tags, guid
+            self.notes[guid] = h
+
+    def update(self, card_dict_by_deck_and_type: Dict, delta: bool = False) -> Dict:
+        """
+        Records the notes in the manifest, and returns them (or if delta=True, only the ones which were added or changed)
+        """
+        cards = ((deck, card_type, *card) for deck, card_dict_by_type in card_dict_by_deck_and_type.items() for card_type, card_list in card_dict_by_type.items() for card in card_list)
+        card_dict_changed = defaultdict(lambda: defaultdict(list))
+        for deck, card_type, *card in self.filter(cards, delta):
+            card_dict_changed[deck][card_type].append(tuple(card))
+        return card_dict_changed
+
+    def save(self) -> None:
+        write_json_atomic(self.path, {"header": self.header, "notes": self.notes})
+
+
+def check_guid_collisions(filename: str, manifest: BuildManifest) -> int:
+    """
+    Warns if another notebook with the same name has cards with the same GUIDs as this one, and returns how many there are.
+
+    GUIDs come from the notebook's name and cell ids (see `card_guid`), so that they don't change when a notebook is moved.
+    But a copy of a notebook in another folder keeps the cell ids, so its cards get the same GUIDs, and importing one of
+    their packages into Anki overwrites the other's notes. To find these, the build manifest of every notebook exported to
+    this media folder (which is shared by everything going into the same Anki collection) is recorded by notebook name in
+    `.jupyter_to_anki_notebooks.json`, and the GUIDs of the other notebooks with the same name are checked against these.
+    """
+    path = get_p_media() / ".jupyter_to_anki_notebooks.json"
+    data = load_json_with_header(path)
+    notebooks = {} if data is None else data.get("notebooks", {})
+    name, path_manifest = Path(filename).name, str(manifest.path.resolve())
+    paths = [p for p in notebooks.get(name, []) if p == path_manifest or Path(p).exists()]
+    num_collisions = 0
+    for p in paths:
+        data = None if p == path_manifest else load_json_with_header(Path(p))
+        if data is not None:
+            num_shared = len(manifest.notes.keys() & data.get("notes", {}).keys())
+            if num_shared:
+                print(f"{num_shared} cards have the same GUIDs as cards in another notebook called {name!r} (whose build manifest is {p!r}), probably because one notebook is a copy of the other. Importing the packages of one of them into Anki will overwrite the other's notes, so rename one of the notebooks.")
+                num_collisions += num_shared
+    if path_manifest not in paths:
+        paths.append(path_manifest)
+    if paths != notebooks.get(name):
+        notebooks[name] = paths
+        write_json_atomic(path, {"notebooks": notebooks})
+    return num_collisions
+
+
+### DUPLICATES
+
+# runs of punctuation and whitespace, which are ignored when comparing the fronts of cards
+NORMALISE_REGEX = re.compile("[\\W_]+")
+# the fronts of cards are compared as sets of shingles (substrings of this many bytes)
+SHINGLE_SIZE = 5
+# number of (16-bit) values in each card's MinHash signature, and number of LSH bands they're split into. With 6 values
+# per band, pairs of cards with similarity 0.7 share a band 92% of the time, and pairs with similarity 0.3 only 1.5%
+MINHASH_SIZE, MINHASH_BANDS = 128, 20
+# splits a signature into its bands
+MINHASH_BAND_STRUCT = struct.Struct(f"{2 * (MINHASH_SIZE // MINHASH_BANDS)}s" * MINHASH_BANDS)
+# the lowest bit of every value in a signature (for counting the values which are different in two signatures)
+MINHASH_LOW_BITS = int.from_bytes(b"\x01\x00" * MINHASH_SIZE, "little")
+# most cards each LSH bucket can hold (so that very common phrases don't make adding cards slow)
+MAX_BUCKET_SIZE = 32
+
+
+def normalise_front(front: str) -> str:
+    """
+    The text of a card's front, for comparing it with other cards: HTML is removed (images are replaced by their filenames,
+    see `strip_html_media`), and it's lowercased, with punctuation and runs of whitespace replaced by single spaces
+    """
+    return NORMALISE_REGEX.sub(" ", strip_html_media(front).lower()).strip()
+
+
+def minhash_signature(text: str) -> int:
+    """
+    MinHash signature of the shingles of `text` (as an int, made of MINHASH_SIZE 16-bit values). The fraction of values which are the
+    same in two signatures is an estimate of the Jaccard similarity of their shingles (see `minhash_similarity`).
+
+    This uses one permutation hashing: each shingle is hashed once, and the hash picks one of the bins and gives the value
+    to take the minimum of in that bin (rather than hashing every shingle once per bin). Empty bins are filled in from the
+    next non-empty bin, plus an offset for how far away it is, so that short texts still get a full signature. Only the
+    lowest 16 bits of each minimum are kept, which makes values the same by chance very rarely (1 in 65536).
+    """
+    data = text.encode("utf-8")
+    hashes = sorted(set(map(zlib.crc32, (data[i:i + SHINGLE_SIZE] for i in range(max(len(data) - SHINGLE_SIZE + 1, 1))))), reverse=True)
+    # (going through the hashes from largest to smallest, the last one written to each bin is the smallest)
+    bins = {h % MINHASH_SIZE: (h // MINHASH_SIZE) & 0xFFFF for h in hashes}
+    values = list(map(bins.get, range(MINHASH_SIZE)))
+    filled = sorted(bins)
+    for previous, b in zip([filled[-1] - MINHASH_SIZE] + filled, filled):
+        # the empty bins before bin b (negative ones are at the end, so they're filled from the first bin)
+        for e in range(previous + 1, b):
+            values[e] = (bins[b] + (b - e) * (0x10000 // MINHASH_SIZE)) & 0xFFFF
+    return int.from_bytes(struct.pack(f"<{MINHASH_SIZE}H", *values), "little")
+
+
+def minhash_similarity(signature_1: int, signature_2: int) -> float:
+    """
+    Fraction of values which are the same in two MinHash signatures
+    """
+    x = signature_1 ^ signature_2
+    # fold the bits of each value into its lowest bit, so that this bit is 1 for the values which are different
+    for shift in [8, 4, 2, 1]:
+        x |= x >> shift
+    x &= MINHASH_LOW_BITS
+    return 1 - (x.bit_count() if hasattr(x, "bit_count") else bin(x).count("1")) / MINHASH_SIZE
+
+
+class DuplicateIndex:
+    """
+    Index of the fronts of cards across notebooks and decks, for finding cards which are the same as (or very similar to)
+    other cards, e.g. because a card was copied and tweaked. It's saved to disk, so cards can be checked against all the
+    cards from earlier runs, and only the notebooks which are read again need updating.
+
+    Exact duplicates are found by a hash of the normalised front (see `normalise_front`). Near-duplicates are found with
+    MinHash and locality sensitive hashing: each signature (see `minhash_signature`) is split into MINHASH_BANDS bands, and
+    a card is only compared with the cards which have the same values as it in at least one band, so finding a card's
+    near-duplicates doesn't mean comparing it with every other card. Cards count as near-duplicates if their estimated
+    similarity is at least `threshold` (if this is None, only exact duplicates are found). Each band's buckets only hold
+    the first MAX_BUCKET_SIZE cards, but near-duplicates almost always share more than one band, so this rarely matters.
+
+    Each card is numbered when it's first added, and a card is only a duplicate of cards which were added before it, so the
+    oldest card is always the original (even if it's edited, or its notebook is read again later).
+    """
+    def __init__(self, path: Union[str, Path], threshold: Optional[float] = 0.7):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.header = {"shingle_size": SHINGLE_SIZE, "minhash_size": MINHASH_SIZE}
+        # (notebook, guid) -> [number, deck, cell, exact hash, signature, start of the normalised front]
+        self.cards = {}
+        self.next_number = 0
+        # number -> (notebook, guid)
+        self.numbers = {}
+        # exact hash / band key -> numbers of the cards with it. Almost all of these only have one card, so they're stored
+        # as just the number, and only become lists when there's more than one (this saves a lot of memory, since there
+        # are MINHASH_BANDS band keys for each card)
+        self.exact = {}
+        self.buckets = {}
+        # notebook -> guids of its cards
+        self.notebooks = defaultdict(set)
+        self.changed = False
+        data = load_json_with_header(self.path, self.header)
+        if data is not None:
+            for notebook, guid, number, deck, cell, exact, signature, front in data["cards"]:
+                signature = int.from_bytes(base64.b64decode(signature), "little")
+                self.insert((notebook, guid), [number, deck, cell, exact, signature, front])
+            self.next_number = data["next_number"]
+
+    @staticmethod
+    def path_for(filename: str) -> Path:
+        return Path(filename).parent / ".jupyter_to_anki_duplicates.json"
+
+    def notebook_key(self, filename: Union[str, Path]) -> str:
+        """
+        How a notebook is stored in the index (its path relative to the index, so the index can be moved with the notebooks)
+        """
+        return relative_path(filename, self.path.parent)
+
+    def band_keys(self, signature: int) -> List[int]:
+        return list(map(hash, enumerate(MINHASH_BAND_STRUCT.unpack_from(signature.to_bytes(2 * MINHASH_SIZE, "little")))))
+
+    @staticmethod
+    def bucket_add(buckets: Dict, k: int, number: int, max_size: Optional[int] = None) -> None:
+        bucket = buckets.setdefault(k, number)
+        if bucket == number:
+            return
+        elif isinstance(bucket, int):
+            buckets[k] = [bucket, number]
+        elif max_size is None or len(bucket) < max_size:
+            bucket.append(number)
+
+    @staticmethod
+    def bucket_remove(buckets: Dict, k: int, number: int) -> None:
+        bucket = buckets.get(k)
+        if bucket == number:
+            del buckets[k]
+        elif isinstance(bucket, list) and number in bucket:
+            bucket.remove(number)
+            if len(bucket) == 1:
+                buckets[k] = bucket[0]
+
+    @staticmethod
+    def bucket_numbers(buckets: Dict, keys: List[int]) -> set:
+        numbers = set()
+        for bucket in map(buckets.get, keys):
+            if isinstance(bucket, list):
+                numbers.update(bucket)
+            elif bucket is not None:
+                numbers.add(bucket)
+        return numbers
+
+    def insert(self, key: Tuple[str, str], entry: List) -> None:
+        number = entry[0]
+        self.cards[key] = entry
+        self.numbers[number] = key
+        self.notebooks[key[0]].add(key[1])
+        self.bucket_add(self.exact, entry[3], number)
+        if self.threshold is not None:
+            for band_key in self.band_keys(entry[4]):
+                self.bucket_add(self.buckets, band_key, number, MAX_BUCKET_SIZE)
+
+    def remove(self, key: Tuple[str, str]) -> None:
+        entry = self.cards.pop(key)
+        number = entry[0]
+        del self.numbers[number]
+        self.notebooks[key[0]].discard(key[1])
+        if not self.notebooks[key[0]]:
+            del self.notebooks[key[0]]
+        self.bucket_remove(self.exact, entry[3], number)
+        if self.threshold is not None:
+            for band_key in self.band_keys(entry[4]):
+                self.bucket_remove(self.buckets, band_key, number)
+        self.changed = True
+
+    def add(self, notebook: str, guid: str, deck: str, cell: int, front: str) -> Optional[Dict]:
+        """
+        Adds a card to the index (replacing it if it's already there), and returns its duplicate (see `find`) if it has one.
+        Cards with nothing on the front aren't added.
+        """
+        key = (notebook, guid)
+        text = normalise_front(front)
+        number = self.cards[key][0] if key in self.cards else None
+        if key in self.cards:
+            self.remove(key)
+        if text == "":
+            return None
+        if number is None:
+            number, self.next_number = self.next_number, self.next_number + 1
+        exact = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+        self.insert(key, [number, deck, cell, exact, minhash_signature(text), text[:80]])
+        self.changed = True
+        return self.find(notebook, guid)
+
+    def find(self, notebook: str, guid: str) -> Optional[Dict]:
+        """
+        If the card is a duplicate (or near-duplicate) of an older card, returns a dict describing both cards (with the
+        estimated similarity, which is 1.0 for exact duplicates), else None. If there are several, the original is the
+        oldest exact duplicate, or (if there aren't any) the oldest near-duplicate.
+        """
+        key = (notebook, guid)
+        if key not in self.cards:
+            return None
+        number, _, _, exact, signature, _ = self.cards[key]
+        original, similarity = self.numbers[min(self.bucket_numbers(self.exact, [exact]))], 1.0
+        if original == key:
+            original = None
+            if self.threshold is not None:
+                candidates = [n for n in self.bucket_numbers(self.buckets, self.band_keys(signature)) if n < number]
+                for n in sorted(candidates):
+                    similarity = minhash_similarity(signature, self.cards[self.numbers[n]][4])
+                    if similarity >= self.threshold:
+                        original = self.numbers[n]
+                        break
+            if original is None:
+                return None
+        describe = lambda k: {"notebook": k[0], "guid": k[1], "deck": self.cards[k][1], "cell": self.cards[k][2], "front": self.cards[k][5]}
+        return dict(describe(key), similarity=similarity, original=describe(original))
+
+    def has_notebook(self, notebook: str) -> bool:
+        return notebook in self.notebooks
+
+    def prune(self, notebook: str, guids: set) -> None:
+        """
+        Removes the cards from a notebook which aren't in `guids` (i.e. which aren't in the notebook any more)
+        """
+        for guid in self.notebooks.get(notebook, set()) - guids:
+            self.remove((notebook, guid))
+
+    def prune_notebooks(self, notebooks: set) -> None:
+        """
+        Removes the cards from notebooks which aren't in `notebooks`
+        """
+        for notebook in set(self.notebooks) - notebooks:
+            for guid in list(self.notebooks[notebook]):
+                self.remove((notebook, guid))
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        cards = [[*key, *entry[:4], base64.b64encode(entry[4].to_bytes(2 * MINHASH_SIZE, "little")).decode(), entry[5]] for key, entry in self.cards.items()]
+        write_json_atomic(self.path, {"header": self.header, "next_number": self.next_number, "cards": cards})
+        self.changed = False
+
+
+def print_duplicates(duplicates: List[Dict], dropped: bool) -> None:
+    """
+    Prints the duplicates found by a `DuplicateIndex`
+    """
+    print("\n======== DUPLICATES ========\n")
+    for d in duplicates:
+        original = d["original"]
+        how = "the same as" if d["similarity"] == 1.0 else f"{d['similarity']:.0%} similar to"
+        print(f"Cell {d['cell']} of {d['notebook']} ({d['deck']}) is {how} cell {original['cell']} of {original['notebook']} ({original['deck']}): {d['front']!r}")
+    if dropped:
+        print(f"\n{len(duplicates)} duplicate cards were left out of the package.")
+
+
+### BUILD REPORT
+
+# the warnings for the card currently being rendered (one list per thread, so cards can be rendered in different threads)
+render_state = threading.local()
+
+def warn(msg: str) -> None:
+    """
+    Records a warning about the card currently being rendered (e.g. potentially bad formatting, to warn the user about)
+    """
+    warnings = getattr(render_state, "warnings", None)
+    if warnings is not None:
+        warnings.append(msg)
+
+
+def timed(iterable, name: str, timings: Dict[str, float]):
+    """
+    Yields the items of `iterable`, adding the time spent getting each one to timings[name]
+    """
+    iterator = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timings[name] += time.perf_counter() - t0
+        yield item
+
+
+class BuildReport:
+    """
+    What happened when a notebook was turned into cards: this is returned by `write_cards_to_anki_package`.
+
+    Attributes are:
+        timings
+            seconds spent in each stage: "load" (reading the notebook), "meta" (finding the decks, tags and cards), "render",
+            "media" (waiting for images to finish being written, which happens in the background while rendering, and
+            saving the media manifest) and "package". Cards go through the first three stages one at a time, so these
+            stages are interleaved (the time for each one doesn't include the stages before it)
+        cards
+            one dict per card, with its deck, card type, cell index, render time (zero if it came from the cache) and the
+            warnings it produced
+        media_bytes
+            bytes of images written to the media folder
+        media_bytes_saved
+            how many bytes smaller those images are than the originals (if images are being optimised, see `ImageOptimizer`)
+        duplicates
+            cards which are duplicates or near-duplicates of older cards (if duplicates are being looked for, see
+            `DuplicateIndex.find`)
+        error
+            the traceback of the exception which stopped the build (in which case no packages were written), or None
+
+    If `on_stage` is given, it's called as on_stage(stage, seconds, report) once each stage is done (e.g. so the timings
+    can be sent somewhere else).
+    """
+    def __init__(self, filename: str, on_stage: Optional[Callable[[str, float, "BuildReport"], None]] = None):
+        self.filename = filename
+        self.on_stage = on_stage
+        self.timings = {}
+        self.cards = []
+        self.media_bytes = 0
+        self.media_bytes_saved = 0
+        self.duplicates = []
+        self.error = None
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        if self.on_stage is not None:
+            self.on_stage(name, seconds, self)
+
+    def add_card(self, deck: str, card_type: str, cell: int, seconds: float, warnings: List[str]) -> None:
+        self.cards.append({"deck": deck, "card_type": card_type, "cell": cell, "seconds": seconds, "warnings": warnings})
+
+    @property
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """
+        Number of cards of each type in each deck
+        """
+        counts = defaultdict(lambda: defaultdict(int))
+        for card in self.cards:
+            counts[card["deck"]][card["card_type"]] += 1
+        return {deck: dict(counts_by_type) for deck, counts_by_type in counts.items()}
+
+    @property
+    def warnings(self) -> List[Tuple[int, str]]:
+        """
+        All the warnings, as (cell index, message) tuples
+        """
+        return [(card["cell"], msg) for card in self.cards for msg in card["warnings"]]
+
+    def slowest_cards(self, n: int = 10) -> List[Dict]:
+        return sorted(self.cards, key=lambda card: card["seconds"], reverse=True)[:n]
+
+    def to_dict(self, n_slowest: int = 10) -> Dict:
+        return {
+            "filename": self.filename,
+            "timings": self.timings,
+            "counts": self.counts,
+            "slowest_cards": self.slowest_cards(n_slowest),
+            "media_bytes": self.media_bytes,
+            "media_bytes_saved": self.media_bytes_saved,
+            "duplicates": self.duplicates,
+            "warnings": self.warnings,
+            "error": self.error,
+        }
+
+    def __repr__(self) -> str:
+        parts = [repr(self.filename), f"{len(self.cards)} cards", f"{len(self.warnings)} warnings", f"{len(self.duplicates)} duplicates", f"{self.media_bytes} bytes of media ({self.media_bytes_saved} saved)"]
+        parts += [f"{name} {seconds:.3f}s" for name, seconds in self.timings.items()]
+        if self.error is not None:
+            # (just the line with the exception, which comes after the last line of the stack)
+            lines = self.error.rstrip().splitlines()
+            stack_lines = [i for i, line in enumerate(lines) if line.startswith(" ")]
+            parts.append(f"error {lines[stack_lines[-1] + 1 if stack_lines else 0]!r}")
+        return f"BuildReport({', '.join(parts)})"
+
+
+### HIGH-LEVEL FUNCTIONS
+
+def write_cards_to_anki_package(filename:str, filename_write:Optional[str]=None, write:bool=True, 
+num_cells_below:Optional[Union[str, int]]=None, overwrite=False, cache:Union[bool, str]=False, workers:Optional[int]=None, delta:bool=False, p_media:Optional[str]=None, on_stage:Optional[Callable]=None, writer:str="genanki", bundle_media:bool=False, optimize_images:Union[bool, Dict]=False, duplicates:Optional[str]=None, duplicate_threshold:Optional[float]=0.7, cell_index:Union[bool, str]=True) -> BuildReport:
+    """
+    Takes filename of current notebook, and writes all cards in the deck to an anki package (.apkg). Returns a report of
+    the build (see `BuildReport`), with timings for each stage, card counts, the slowest cards and any warnings.
+
+    Arguments are:
+        filename
+            the notebook you want to read cards from (must be the same one you're running this function within)
+        filename_write
+            if None, the filename is chosen by appending to `filename`
+            if string, this is chosen as the filename (path can be relative or absolute)
+        write
+            if True, it will write cards to a deck
+            if False, it will print information about the cards (useful for last minute checks)
+        num_cells_below
+            if None (default), it will convert all markdown cells to Anki cards
+            if "all", it will convert all cells below the one you ran this function in
+            if a positive integer, it will convert this many cells below
+        overwrite
+            if True, then the newly created cards will overwrite whatever was stored in that `filename_write` Anki deck before
+            if False, then they won't overwrite, but will instead have a suffix added to their filename (e.g. "_001")
+        cache
+            if False (default), every card is rendered from scratch
+            if True, rendered cards are cached in `.jupyter_to_anki_cache.json` (next to the notebook), so cells which haven't changed since the last run aren't rendered again
+            if a string, this is used as the path of the cache file
+        workers
+            if None (default), cards are rendered one at a time
+            if an integer greater than 1, cards are rendered in a pool of this many processes (the output is exactly the same)
+        delta
+            if False (default), every card is written
+            if True, only cards which were added or changed since the last time you wrote this package are written (notes
+            have stable ids, so importing them into Anki updates the notes you already have)
+        p_media
+            if None (default), the media folder is found as described in `get_p_media`
+            if a string, this is used as the media folder
+        on_stage
+            if given, this is called as on_stage(stage, seconds, report) at the end of each stage of the build
+        writer
+            if "genanki" (default), the packages are written by genanki
+            if "sqlite", they're written straight into the database (see `write_collection`), which is faster for big decks
+        bundle_media
+            if False (default), images are written to the media folder, and the packages don't contain them
+            if True, the images are put inside the packages (so you don't need a media folder). They're written to
+                `p_media` if it's given, otherwise to a folder called `.<filename_write>_media` next to the packages
+        optimize_images
+            if False (default), images are written exactly as they are in the notebook
+            if True, images are scaled down and compressed before they're written (see `ImageOptimizer`, this needs Pillow)
+            if a dict, this is used as the settings, e.g. {"max_size": 1200, "quality": 80, "format": "webp"}
+        duplicates
+            if None (default), cards aren't checked for duplicates
+            if "report", cards whose front is the same as (or similar to) an older card's are printed, and recorded in the
+                report. Cards are checked against every card read from notebooks in the same folder as this one, which are
+                kept in `.jupyter_to_anki_duplicates.json` (see `DuplicateIndex`)
+            if "drop", these cards are also left out of the packages
+        duplicate_threshold
+            how similar two cards' fronts have to be to count as near-duplicates (0.7 by default), or None to only find cards
+            whose fronts are exactly the same (ignoring case, whitespace and punctuation)
+        cell_index
+            if True (default), and num_cells_below isn't None, the cells are found using an index of the notebook's cells
+                kept in `.<notebook name>_cells.json` (see `CellIndex`), so only the cells which are turned into cards
+                are read
+            if a string, this is used as the path of the index
+            if False, the whole notebook is read
+    """
+
+    # Do some type-checking
+    if num_cells_below is not None:
+        s = f"Argument {num_cells_below=} should be None, a positive integer, or the string 'all'."
+        n = num_cells_below
+        assert any([(type(n) == int) and (n >= 1), n == "any"]), s
+
+    if filename_write is None:
+        filename_write = filename
+    filename_stem = filename_write if not filename_write.endswith(".apkg") else filename_write[:-5]
+    manifest = BuildManifest(BuildManifest.path_for(filename_stem))
+    media_folder = None
+    if bundle_media:
+        media_folder = Path(p_media) if p_media is not None else bundled_media_folder(filename_stem)
+        media_folder.mkdir(parents=True, exist_ok=True)
+        p_media = str(media_folder)
+
+    # Reads the cards one at a time (see `iter_cards`), recording them in the build manifest as they go past (and if
+    # delta=True, only keeping the ones which have changed since last time). This gives a card dict: keys are decks, values
+    # are dicts. Each of these dicts has keys = card types, values = lists of (card contents, tags, guid)-tuples
+    report = BuildReport(filename, on_stage)
+    duplicate_index = DuplicateIndex(DuplicateIndex.path_for(filename), duplicate_threshold) if duplicates is not None else None
+    card_dict_by_deck_and_type = defaultdict(lambda: defaultdict(list))
+    with using_media(p_media, optimize_images):
+        try:
+            cards = iter_cards(filename, num_cells_below, cache, workers, report=report, duplicates=duplicates, duplicate_index=duplicate_index, cell_index=cell_index)
+            for deck, card_type, *card in manifest.filter(cards, delta):
+                card_dict_by_deck_and_type[deck][card_type].append(tuple(card))
+        # if anything went wrong, we don't write any packages (or update the manifest)
+        except:
+            report.error = print_read_error()
+            return report
+        check_guid_collisions(filename, manifest)
+    if delta:
+        num_changed = sum(len(card_list) for card_dict_by_type in card_dict_by_deck_and_type.values() for card_list in card_dict_by_type.values())
+        print(f"{num_changed} cards have been added or changed since the last package was written.")
+
+    # each deck's cards are dropped once its package has been written
+    t0 = time.perf_counter()
+    for deck in list(card_dict_by_deck_and_type):
+        write_deck_package(deck, card_dict_by_deck_and_type.pop(deck), filename_stem, overwrite, writer, media_folder)
+
+    manifest.save()
+    if duplicate_index is not None:
+        duplicate_index.save()
+    report.record_stage("package", time.perf_counter() - t0)
+
+    return report
+
+
+def write_deck_package(deck: str, card_dict_by_type: Dict, filename_stem: str, overwrite: bool, writer: str = "genanki", media_folder: Optional[Path] = None) -> str:
+    """
+    Writes a single deck to its own anki package (named by appending the deck name to `filename_stem`), and returns the
+    filename (see `write_package` for the other arguments)
+    """
+    # Get a filename to write to
+    filename_write = filename_stem + f"_{deck=}"
+    filename_write = filename_write.replace("'", "").replace('"', '')
+    if overwrite == False and Path(filename_write + ".apkg").exists():
+        counter = 1
+        while Path(f"{filename_write}_{counter:02}.apkg").exists():
+            counter += 1
+        filename_write = f"{filename_write}_{counter:02}.apkg"
+
+    # Write the cards
+    write_package(filename_write + ".apkg", {deck: card_dict_by_type}, writer, media_folder)
+    return filename_write + ".apkg"
+
+
+def write_package(filename: Union[str, Path], card_dict_by_deck_and_type: Dict, writer: str = "genanki", media_folder: Optional[Path] = None, timestamp: Optional[float] = None) -> None:
+    """
+    Writes decks to an anki package (keys are deck names, values are dicts of cards by card type, like `read_cards` returns).
+
+    The collection database inside the package is written by genanki if writer="genanki", or by `write_collection` if
+    writer="sqlite" (the notes and cards are the same either way). If `media_folder` is given, the images used by the cards
+    are copied from it into the package, so the package works without the media folder. Each image is only stored once,
+    and images which are already compressed (jpg, png, gif and webp) are stored without compressing them again.
+    """
+    assert writer in ["genanki", "sqlite"], f"Expected writer to be 'genanki' or 'sqlite', instead found {writer!r}.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+    import sqlite3
+    import tempfile
+    import zipfile
+    if timestamp is None:
+        timestamp = time.time()
+
+    fd, path_db = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path_db)
+        if writer == "genanki":
+            import genanki
+            decks = [build_deck(deck, card_dict_by_type) for deck, card_dict_by_type in card_dict_by_deck_and_type.items()]
+            genanki.Package(decks).write_to_db(conn.cursor(), timestamp, itertools.count(int(timestamp * 1000)))
+            conn.commit()
+        else:
+            write_collection(conn, card_dict_by_deck_and_type, timestamp)
+        conn.close()
+
+        # find the images used by the cards (in the order they're first used, and each one only once)
+        media = {}
+        if media_folder is not None:
+            img_names = dict.fromkeys(
+                img_name
+                for card_dict_by_type in card_dict_by_deck_and_type.values() for card_list in card_dict_by_type.values()
+                for fields, *_ in card_list for field in fields for img_name in IMG_SRC_REGEX.findall(field)
+            )
+            for img_name in img_names:
+                if (Path(media_folder) / img_name).exists():
+                    media[str(len(media))] = img_name
+                else:
+                    print(f"Couldn't find the image {img_name} in {str(media_folder)!r}, so it won't be in the package {str(filename)!r}. If the notebook was read before you started bundling images, try reading it again (e.g. with `--force`).")
+
+        # the package is a zip file containing the database, a map from numbered files to image names, and the images
+        with zipfile.ZipFile(filename, "w") as outzip:
+            outzip.write(path_db, "collection.anki2")
+            outzip.writestr("media", json.dumps(media))
+            for idx, img_name in media.items():
+                compress_type = zipfile.ZIP_STORED if img_name.rsplit(".", 1)[-1].lower() in PRECOMPRESSED_FILETYPES else zipfile.ZIP_DEFLATED
+                outzip.write(Path(media_folder) / img_name, idx, compress_type=compress_type)
+    finally:
+        os.remove(path_db)
+
+
+def write_collection(conn: "sqlite3.Connection", card_dict_by_deck_and_type: Dict, timestamp: float) -> None:
+    """
+    Writes decks into an empty collection database. This gives the same notes and cards as genanki does (with the same ids,
+    for the same timestamp), but it's faster for big decks: every row is worked out first, then they're all inserted
+    with `executemany` in a single transaction. It also fills in each note's sort field and checksum the way Anki does
+    (genanki leaves these for Anki to fill in), and doesn't check the fields for invalid HTML (our fields are generated).
+    """
+    import genanki
+    from genanki.apkg_col import APKG_COL
+    from genanki.apkg_schema import APKG_SCHEMA
+
+    # the database is a temporary file which gets zipped up afterwards, so it doesn't need to survive a crash. The indexes
+    # are created after the rows are inserted, since building them in one go is quicker than updating them for every row
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    statements = [statement.strip() for statement in APKG_SCHEMA.split(";") if statement.strip()]
+    create_indexes = [statement for statement in statements if statement.upper().startswith("CREATE INDEX")]
+    conn.executescript(";\n".join(statement for statement in statements if statement not in create_indexes) + ";")
+    conn.executescript(APKG_COL)
+    decks_json, models_json = (json.loads(s) for s in conn.execute("SELECT decks, models FROM col").fetchone())
+
+    # ids are given out in the same order as genanki does (each note, followed by its cards)
+    id_gen = itertools.count(int(timestamp * 1000))
+    mod = int(timestamp)
+    notes, cards = [], []
+    for deck, card_dict_by_type in card_dict_by_deck_and_type.items():
+        deck_id = encode_str(deck)
+        decks_json[str(deck_id)] = genanki.Deck(deck_id=deck_id, name=deck).to_json()
+        for card_type, card_list in card_dict_by_type.items():
+            model = get_model(card_type)
+            models_json[str(model.model_id)] = model.to_json(timestamp, deck_id)
+            # a note only gets a card if the fields its template needs aren't empty
+            card_reqs = [(card_ord, any if any_or_all == "any" else all, field_ords) for card_ord, any_or_all, field_ords in model._req]
+            for fields, tags, guid in card_list:
+                if len(fields) != len(model.fields):
+                    raise ValueError(f"Expected {len(model.fields)} fields for a {card_type!r} card, instead found {len(fields)}.")
+                note_id = next(id_gen)
+                # the sort field is the first field (which is also the one the checksum is taken from)
+                sort_field = strip_html_media(fields[model.sort_field_index])
+                csum = field_checksum(sort_field if model.sort_field_index == 0 else strip_html_media(fields[0]))
+                notes.append((note_id, guid, model.model_id, mod, -1, " " + " ".join(tags) + " ", "\x1f".join(fields), sort_field, csum, 0, ""))
+                for card_ord, op, field_ords in card_reqs:
+                    if op(fields[i] for i in field_ords):
+                        cards.append((next(id_gen), note_id, deck_id, card_ord, mod, -1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ""))
+
+    with conn:
+        conn.execute("UPDATE col SET decks = ?, models = ?", (json.dumps(decks_json), json.dumps(models_json)))
+        conn.executemany("INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)", notes)
+        conn.executemany("INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", cards)
+        for statement in create_indexes:
+            conn.execute(statement)
+
+
+def bundled_media_folder(filename_write: Union[str, Path]) -> Path:
+    """
+    Returns the folder images are written to when they're bundled into packages (it's kept between builds, like the media
+    folder, so images don't have to be written again)
+    """
+    filename_write = Path(filename_write)
+    return filename_write.with_name(f".{filename_write.stem}_media")
+
+
+# genanki models, keyed by card type and a hash of its templates (so each one is only built once per process)
+models = {}
+
+def get_model(card_type: str) -> "genanki.Model":
+    """
+    Returns the genanki model (equivalent to a note type in Anki) for this card type. The same model object is used for
+    every deck and package, so the templates aren't copied, and genanki only has to work out which fields each card
+    template needs once.
+    """
+    import genanki
+    templates = get_templates_dict()[card_type]
+    key = (card_type, hashlib.sha256(json.dumps(templates, sort_keys=True).encode()).hexdigest())
+    if key not in models:
+        # Generate a hash to uniquely refer to this note type (has to be the same each time you run this function)
+        h_type = encode_str(card_type + "0")
+        # Get the correct fields
+        fields = [{'name': 'Front'}, {'name': 'Hint'}]
+        if card_type in ["front-back", "image"]: fields.insert(1, {'name': 'Back'})
+        models[key] = genanki.Model(
+            model_id=h_type,
+            name=card_type,
+            fields=fields,
+            templates=[{
+                'name': 'Card 1',
+                'qfmt': templates["front"],
+                'afmt': templates["back"],
+            }],
+            css=templates["css"]
+        )
+    return models[key]
+
+
+def build_deck(deck: str, card_dict_by_type: Dict) -> "genanki.Deck":
+    """
+    Creates a genanki deck from a dict of cards (keys are card types, values are lists of (card contents, tags, guid)-tuples)
+    """
+    import genanki
+
+    # Generate a hash to uniquely refer to this deck (has to be the same each time you run this function)
+    h_deck = encode_str(deck)
+    # Create a deck object
+    my_deck = genanki.Deck(
+        deck_id=h_deck,
+        name=deck
+    )
+
+    for card_type, card_list in card_dict_by_type.items():
+
+        my_model = get_model(card_type)
+
+        # Write all the Anki cards to this deck
+        for (fields, tags, guid) in card_list:
+            my_note = genanki.Note(
+                model=my_model,
+                fields=fields,
+                tags=tags,
+                guid=guid
+            )
+            my_deck.add_note(my_note)
+
+    return my_deck
+
+
+def relative_path(path: Union[str, Path], folder: Union[str, Path]) -> str:
+    """
+    The path relative to a folder (or the absolute path, if it's on a different drive)
+    """
+    try:
+        return os.path.relpath(Path(path).resolve(), Path(folder).resolve())
+    except ValueError:
+        return str(Path(path).resolve())
+
+
+def find_notebooks(paths: List[str]) -> List[Path]:
+    """
+    Returns all the notebooks in the given paths (which can be notebooks, or directories to search recursively), sorted so
+    that the order is the same every time (checkpoints saved by Jupyter are ignored)
+    """
+    notebooks = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            notebooks.extend(p for p in sorted(path.rglob("*.ipynb")) if ".ipynb_checkpoints" not in p.parts)
+        else:
+            assert path.suffix == ".ipynb" and path.exists(), f"Expected a notebook or a directory, instead found {str(path)!r}."
+            notebooks.append(path)
+    return notebooks
+
+
+def build_anki_package(paths: List[str], filename_write:str="anki.apkg", force:bool=False, cache:Union[bool, str]=False, workers:Optional[int]=None, delta:bool=False, p_media:Optional[str]=None, writer:str="genanki", bundle_media:bool=False, optimize_images:Union[bool, Dict]=False, duplicates:Optional[str]=None, duplicate_threshold:Optional[float]=0.7) -> Optional[int]:
+    """
+    Reads every notebook in `paths`, and writes all the cards into a single anki package (with one deck per DECK name, so
+    cards with the same deck in different notebooks end up in the same deck). Returns the number of cards written, or None
+    if any of the notebooks couldn't be read (in which case the package and build state are left as they were).
+
+    Unlike `write_cards_to_anki_package`, this is run from outside the notebooks, so they don't need a cell which calls it.
+    The cards read from each notebook are saved in a build state file next to the package, along with the notebook's mtime
+    and hash. Notebooks which haven't changed since the last build aren't read again (and if none of them have changed,
+    the package isn't rewritten).
+
+    Arguments are:
+        paths
+            list of notebooks, or directories which will be searched for notebooks
+        filename_write
+            the filename of the package
+        force
+            if True, every notebook is read again, even if it hasn't changed
+        cache, workers, delta, p_media, writer, bundle_media, optimize_images, duplicates, duplicate_threshold
+            same as for `write_cards_to_anki_package`, except that the cards are checked against every card in the package
+            (the duplicate index is kept next to the package, in `.<package name>_duplicates.json`)
+    """
+    assert duplicates in [None, "report", "drop"], f"Expected duplicates to be None, 'report' or 'drop', instead found {duplicates!r}.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+    image_optimizer = ImageOptimizer.from_arg(optimize_images)
+    images_key = None if image_optimizer is None else image_optimizer.key
+    filename_write = Path(filename_write if filename_write.endswith(".apkg") else filename_write + ".apkg")
+    media_folder = None
+    if bundle_media:
+        media_folder = Path(p_media) if p_media is not None else bundled_media_folder(filename_write)
+        media_folder.mkdir(parents=True, exist_ok=True)
+        p_media = str(media_folder)
+    path_state = filename_write.parent / f".{filename_write.stem}_build.json"
+    duplicate_index = None
+    if duplicates is not None:
+        duplicate_index = DuplicateIndex(filename_write.parent / f".{filename_write.stem}_duplicates.json", duplicate_threshold)
+    # cards saved by an older version of this code might not be in the same format (and the names of their images depend
+    # on the image optimiser settings, and their images are only in the media folder they were read with)
+    state_header = {"renderer_version": RENDERER_VERSION, "images": images_key, "media": None if p_media is None else str(Path(p_media).resolve())}
+    data = None if force else load_json_with_header(path_state, state_header)
+    state = {} if data is None else data["notebooks"]
+    # the options which only change how the package is written (if these have changed, the package is written again, but
+    # the notebooks don't need to be read again) - this includes the duplicate settings, since duplicates are only found
+    # (and dropped) when the package is written
+    package_options = {"writer": writer, "bundle_media": bundle_media, "duplicates": duplicates, "duplicate_threshold": duplicate_threshold}
+
+    # read the notebooks which have changed (or just update the mtime, if only that has changed)
+    new_state = {}
+    num_changed = 0
+    failed = []
+    for notebook in find_notebooks(paths):
+        key = str(notebook.resolve())
+        mtime = notebook.stat().st_mtime_ns
+        notebook_state = state.get(key)
+        # (notebooks which aren't in the duplicate index yet have to be read again, to add their cards to it)
+        if duplicate_index is not None and not duplicate_index.has_notebook(duplicate_index.notebook_key(notebook)):
+            notebook_state = None
+        if notebook_state is not None and notebook_state["mtime"] != mtime:
+            h = hashlib.sha256(notebook.read_bytes()).hexdigest()
+            notebook_state = dict(notebook_state, mtime=mtime) if notebook_state["sha256"] == h else None
+        if notebook_state is None:
+            print(f"Reading {str(notebook)!r}")
+            h = hashlib.sha256(notebook.read_bytes()).hexdigest()
+            cards = defaultdict(lambda: defaultdict(list))
+            with using_media(p_media, image_optimizer or False):
+                try:
+                    for deck, card_type, fields, tags, guid in iter_cards(str(notebook), None, cache, workers, require_call_cell=False, duplicate_index=duplicate_index):
+                        cards[deck][card_type].append((fields, tags, guid))
+                # (unlike `read_cards`, the cards read before the error aren't kept, otherwise they'd be saved in the
+                # build state as if they were all the notebook's cards)
+                except:
+                    print_read_error()
+                    failed.append(notebook)
+                    continue
+            notebook_state = {"mtime": mtime, "sha256": h, "cards": cards}
+            num_changed += 1
+        new_state[key] = notebook_state
+
+    if failed:
+        print(f"Couldn't read {', '.join(repr(str(notebook)) for notebook in failed)}, so {str(filename_write)!r} wasn't written.")
+        return None
+
+    if num_changed == 0 and len(new_state) == len(state) and filename_write.exists() and data is not None and data.get("package") == package_options:
+        print(f"No notebooks have changed since {str(filename_write)!r} was written.")
+        return sum(len(card_list) for notebook_state in new_state.values() for card_dict_by_type in notebook_state["cards"].values() for card_list in card_dict_by_type.values())
+
+    # find the duplicates across all the notebooks (every card is in the index by now, so this doesn't read anything)
+    duplicate_list = []
+    if duplicate_index is not None:
+        notebook_keys = {key: duplicate_index.notebook_key(key) for key in new_state}
+        duplicate_index.prune_notebooks(set(notebook_keys.values()))
+        for key, notebook_state in new_state.items():
+            for card_dict_by_type in notebook_state["cards"].values():
+                for card_list in card_dict_by_type.values():
+                    duplicate_list.extend(filter(None, (duplicate_index.find(notebook_keys[key], guid) for _, _, guid in card_list)))
+        duplicate_index.save()
+        if duplicate_list:
+            print_duplicates(duplicate_list, dropped=duplicates == "drop")
+    dropped = {(d["notebook"], d["guid"]) for d in duplicate_list} if duplicates == "drop" else set()
+
+    # merge the cards from all notebooks (keeping decks and card types in the order they first appear)
+    # GUIDs only depend on the notebook's name, so notebooks with the same name in different folders can give the same
+    # GUID to different cards. The first notebook keeps it, and the others' are made from their path relative to the package
+    import genanki
+    card_dict_by_deck_and_type = defaultdict(lambda: defaultdict(list))
+    guid_notebooks = {}
+    for key, notebook_state in new_state.items():
+        for deck, card_dict_by_type in notebook_state["cards"].items():
+            for card_type, card_list in card_dict_by_type.items():
+                for fields, tags, guid in card_list:
+                    if dropped and (notebook_keys[key], guid) in dropped:
+                        continue
+                    if guid_notebooks.setdefault(guid, key) != key:
+                        guid = genanki.guid_for(Path(relative_path(key, filename_write.parent)).as_posix(), guid)
+                    card_dict_by_deck_and_type[deck][card_type].append((fields, tags, guid))
+
+    # record the cards in the build manifest (and if delta=True, only keep the ones which have changed since last time)
+    manifest = BuildManifest(BuildManifest.path_for(filename_write))
+    card_dict_by_deck_and_type = manifest.update(card_dict_by_deck_and_type, delta)
+
+    num_cards = sum(len(card_list) for card_dict_by_type in card_dict_by_deck_and_type.values() for card_list in card_dict_by_type.values())
+    if delta and num_cards == 0:
+        print(f"No cards have been added or changed since {str(filename_write)!r} was written.")
+    else:
+        write_package(filename_write, card_dict_by_deck_and_type, writer, media_folder)
+        print(f"Wrote {num_cards} cards in {len(card_dict_by_deck_and_type)} decks from {len(new_state)} notebooks to {str(filename_write)!r}.")
+    manifest.save()
+
+    write_json_atomic(path_state, {"header": state_header, "package": package_options, "notebooks": new_state})
+
+    return num_cards
+
+
+META_REGEX_DICT = {keyword: re.compile(f"{keyword}\\s*=\\s*", re.IGNORECASE) for keyword in ["tags", "deck", "url"]}
+
+def match_meta(s):
+    """
+    Useful shorthand, returns boolean for whether this line of the cell is a meta line
+    """
+    for keyword, regex in META_REGEX_DICT.items():
+        if regex.match(s):
+            return keyword, regex.sub("", s).strip()
+    return False
 
-p_media = Path("")
-assert len(p_media.anchor) > 0, "You need to change `p_media` in the Python file you downloaded. See the GitHub instructions for more."
 
-# Generate the dictionary of card templates
-templates_dict = defaultdict(dict)
-for card_type in ["front", "front-back", "image"]:
-    for group in ["front", "back", "css"]:
-        with open(Path(__file__).parent / f"templates/{card_type}-{group[0]}.txt", encoding="utf-8") as f:
-            templates_dict[card_type][group] = f.read()
+def cell_kind(cell_dict: Dict) -> Optional[str]:
+    """
+    What a cell (from `iter_notebook_cells`) is: "call" for code cells which call `write_cards_to_anki_package`, "meta" for
+    markdown cells which only contain DECK / TAGS / URL lines, "card" for all other markdown cells (apart from the ones which
+    start with a header), and None for anything else
+    """
+    cell = cell_dict["source"]
+    if cell_dict["cell_type"] == "code":
+        return "call" if any("write_cards_to_anki_package(" in line for line in cell) else None
+    if cell_dict["cell_type"] != "markdown":
+        return None
+    if all(match_meta(line) for line in cell):
+        return "meta"
+    # A markdown cell is Anki iff it doesn't start w/ a header
+    return None if cell[0].startswith("#") else "card"
 
-### MISC FUNCTIONS
 
-def encode_str(s):
-    return int(hashlib.sha256(bytes(s, encoding="utf-8")).hexdigest(), 16) % (10 ** 10)
+def iter_cards(filename:str, num_cells_below:Optional[Union[int, str]]=None, cache:Union[bool, str, RenderCache]=False, workers:Optional[int]=None, require_call_cell:bool=True, report:Optional[BuildReport]=None, duplicates:Optional[str]=None, duplicate_index:Optional[DuplicateIndex]=None, cell_index:Union[bool, str, CellIndex]=True):
+    """
+    Yields (deck, card_type, fields, tags, guid) for every card in the notebook, in order. This is what `read_cards` and
+    `write_cards_to_anki_package` are built on.
 
-def get_filename_from_json_data(json_data, filetype="jpg"):
-    
-    return hashlib.sha256(bytes(json_data, "utf-8")).hexdigest() + "." + filetype
+    Each stage is a generator (cells -> cards -> rendered cards), so the notebook is read one cell at a time, and each card's
+    attachments are dropped as soon as it's been rendered. This means memory is bounded by the largest card rather than the
+    size of the notebook. Arguments are the same as for `read_cards`, except that the media folder has to be set by the
+    caller. Exceptions aren't caught, and can happen after some of the cards have been yielded.
+    """
+    # do some type checking of arguments
+    n = num_cells_below
+    assert any([n is None, n == "all", (isinstance(n, int) and n >= 1)]), f"{num_cells_below = }, this is not allowed. Expected values are `None`, 'all' or positive integer.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+    assert duplicates in [None, "report", "drop"], f"Expected duplicates to be None, 'report' or 'drop', instead found {duplicates!r}.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
 
-def get_random_seed_for_inputs(i_value, increment):
+    if report is None:
+        report = BuildReport(filename)
+
+    # if filename includes a stem, deal with this
+    if not filename.endswith(".ipynb"):
+        filename += ".ipynb"
+
+    # load the render cache (cards whose cell, attachments and meta are unchanged since the last run won't be rendered again)
+    render_cache = None
+    if isinstance(cache, RenderCache):
+        render_cache = cache
+    elif cache:
+        render_cache = RenderCache(Path(filename).parent / ".jupyter_to_anki_cache.json" if cache is True else cache)
+
+    # load the duplicate index (every card is added to it, and if `duplicates` is given, the ones which are duplicates of
+    # older cards are reported or dropped)
+    save_duplicate_index = duplicate_index is None and duplicates is not None
+    if save_duplicate_index:
+        duplicate_index = DuplicateIndex(DuplicateIndex.path_for(filename))
+    if duplicate_index is not None:
+        notebook_key, guids = duplicate_index.notebook_key(filename), set()
+
+    # chain the stages together (the time spent in each one is measured including the stages before it, so we subtract)
+    media_store = get_media_store()
+    media_store.refresh()
+    bytes_written, bytes_saved = media_store.bytes_written, media_store.bytes_saved
+    timings = defaultdict(float)
+    # (for a partial export, the cell index tells us which cells to read, so we don't have to read the rest of the notebook)
+    if num_cells_below is not None and cell_index:
+        if not isinstance(cell_index, CellIndex):
+            cell_index = CellIndex(CellIndex.path_for(filename) if cell_index is True else cell_index)
+        card_cells = timed(cell_index.iter_card_cells(filename, num_cells_below, timings), "meta", timings)
+    else:
+        cells = timed(iter_notebook_cells(filename), "load", timings)
+        card_cells = timed(iter_card_cells(cells, filename, num_cells_below, require_call_cell), "meta", timings)
+    rendered_cards = timed(iter_rendered_cards(card_cells, render_cache, workers), "render", timings)
+
+    # images are written in the background, so we don't know which ones failed until the end. We keep the names of each
+    # card's images (but nothing else), so that failures can be reported as warnings for the cards which use them
+    card_warnings_by_image = defaultdict(list)
+    for (deck, card, images_dict, tags, url, guid, i), (card_type, fields, card_errors, (seconds, media_bytes, media_bytes_saved, media_failures)) in rendered_cards:
+        card_errors = card_errors + [f"Couldn't write the image {img_name} to the media folder ({error}), so it will be missing from this card." for img_name, error in media_failures.items()]
+        report.media_bytes += media_bytes
+        report.media_bytes_saved += media_bytes_saved
+        # (duplicates which are dropped aren't counted as cards in the report)
+        if duplicate_index is not None:
+            guids.add(guid)
+            duplicate = duplicate_index.add(notebook_key, guid, deck, i, fields[0])
+            if duplicate is not None and duplicates is not None:
+                report.duplicates.append(duplicate)
+                if duplicates == "drop":
+                    continue
+        report.add_card(deck, card_type, i, seconds, card_errors)
+        for img_name in dict.fromkeys(img_name for field in fields for img_name in IMG_SRC_REGEX.findall(field)):
+            if img_name not in media_failures:
+                card_warnings_by_image[img_name].append(card_errors)
+        yield deck, card_type, fields, tags.split(" "), guid
+
+    # wait for the images to be written (this has to happen before the package is written)
+    t0 = time.perf_counter()
+    for img_name, error in media_store.wait().items():
+        for card_errors in card_warnings_by_image.get(img_name, []):
+            card_errors.append(f"Couldn't write the image {img_name} to the media folder ({error}), so it will be missing from this card.")
+    media_store.save()
+    report.media_bytes += media_store.bytes_written - bytes_written
+    report.media_bytes_saved += media_store.bytes_saved - bytes_saved
+    timings["media"] = time.perf_counter() - t0
+    for name, name_before in [("load", None), ("meta", "load"), ("render", "meta"), ("media", None)]:
+        report.record_stage(name, timings[name] - timings.get(name_before, 0.0))
+
+    if render_cache is not None:
+        render_cache.save()
+
+    # cards which aren't in the notebook any more are removed from the duplicate index (unless we only read part of it)
+    if duplicate_index is not None:
+        if num_cells_below is None:
+            duplicate_index.prune(notebook_key, guids)
+        if save_duplicate_index:
+            duplicate_index.save()
+        if report.duplicates:
+            print_duplicates(report.duplicates, dropped=duplicates == "drop")
+
+    # Warnings for things like potentially bad formatting in the cards, to warn the user about (grouped by deck)
+    if len(report.warnings) > 0:
+        print("\n======== ERROR MESSAGES ========\n")
+        decks = list(dict.fromkeys(card["deck"] for card in report.cards))
+        for card in sorted(report.cards, key=lambda card: decks.index(card["deck"])):
+            for msg in card["warnings"]: print(msg)
+
+
+def read_cards(filename:str, write:bool, num_cells_below:Optional[Union[int, str]], cache:Union[bool, str]=False, workers:Optional[int]=None, require_call_cell:bool=True, p_media:Optional[str]=None, report:Optional[BuildReport]=None, optimize_images:Union[bool, Dict]=False, duplicates:Optional[str]=None, duplicate_index:Optional[DuplicateIndex]=None, cell_index:Union[bool, str, CellIndex]=True):
     """
-    Generates a random seed for use in the Anki input field.
+    Opens a Jupyter Notebook given by filename, reads all the cards in non-tag markdown cells, and returns them sorted by deck and note type (values are lists of (fields, tags, guid)-tuples)
     
-    Note that the purpose of "increment" is to make sure the same field showing up twice doesn't lead to the same random seed
+    INPUTS
+        filename        | should be name of notebook you're converting to Anki (ideally the current notebook)
+        write           | if false, it doesn't write cards to an `.apkg` file (only do True when you're sure you're done with the cards)
+        num_cells_below | None => writes every cell (default), "all" => writes all cells below, int => num cells below
+        cache           | False => no caching (default), True => cache rendered cards next to the notebook, str => path of the cache file, RenderCache => use this cache
+        workers         | None => renders cards one at a time (default), int => renders cards in a pool of this many processes
+        require_call_cell | if False, the notebook doesn't need a cell calling `write_cards_to_anki_package` (only allowed if num_cells_below is None)
+        p_media         | None => media folder is found as described in `get_p_media` (default), str => media folder
+        report          | if given, the timings, cards and warnings are recorded in this `BuildReport`
+        optimize_images | False => images are written as they are (default), True or dict => images are optimised (see `ImageOptimizer`)
+        duplicates      | None => cards aren't checked for duplicates (default), "report" => duplicates of older cards are printed, "drop" => they're also left out
+        duplicate_index | None => the index next to the notebook is used (if `duplicates` is given), DuplicateIndex => every card is added to this index
+        cell_index      | True => partial exports (num_cells_below isn't None) use the cell index next to the notebook (default), str => path of the cell index, False => they read the whole notebook
     """
-    h = hashlib.sha256(bytes(i_value + str(increment), "utf-8")).hexdigest()
-    h = "".join([ch for ch in h if ch.isdigit()])
-    return f"{int(h[:8]):08d}"
+    # initialised here so that in the event of an error, the cards read so far can be returned (helps with bug-fixing)
+    cards_processed_dict = defaultdict(lambda: defaultdict(list))
 
-def get_card_type_and_hint(card) -> Tuple[str, int, int, int]:
-    """
-    Figures out whether it's a front or front-back or image card, based on whether it contains a `-` or `-i` separator.
+    with using_media(p_media, optimize_images):
+        try:
+            for deck, card_type, fields, tags, guid in iter_cards(filename, num_cells_below, cache, workers, require_call_cell, report, duplicates, duplicate_index, cell_index):
+                cards_processed_dict[deck][card_type].append((fields, tags, guid))
+        # Exceptions here usually mean the notebook hasn't been properly cleared (e.g. images or printed output can mess with it)
+        except:
+            print_read_error()
 
-    Also figures out whether it's got a hint, based on whether it contains a `-h` separator.
-    """
+    return cards_processed_dict
 
-    all_separators = [c.strip() for c in card if c.strip().startswith("-")]
-    assert len(all_separators) <= 2, f"There should be at most separators (lines starting with '-'), instead we found {len(all_separators)} in one of your cards.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
-    bad_separators = [sep for sep in all_separators if sep not in ["-", "-h", "-i"]]
-    assert len(bad_separators) == 0, f"The only allowed separators (lines starting with '-') are '-' (for front/back), '-i' (for image cards) and '-h' (for hints). Instead we found the separators {bad_separators} in one of your cards.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
-    
-    separators = [(i, c.strip()) for i, c in enumerate(card) if c.strip() in ["-", "-i", "-h"]]
-    if "-" in all_separators:
-        fb_separator, img_separator = min([i for i, c in separators if c == "-"]), 0
-        card_type = "front-back"
-    elif "-i" in all_separators:
-        fb_separator, img_separator = 0, min([i for i, c in separators if c == "-i"])
-        card_type = "image"
+
+@contextlib.contextmanager
+def using_media(p_media: Optional[str], optimize_images: Union[bool, Dict, "ImageOptimizer"] = False):
+    """
+    Uses the media folder passed as an argument until the block is done (or if there isn't one, checks that it's been set),
+    and the image optimiser for the `optimize_images` argument
+    """
+    global p_media_arg, image_optimizer_arg
+    p_media_arg_outer, image_optimizer_arg_outer = p_media_arg, image_optimizer_arg
+    if p_media is None:
+        get_p_media()
     else:
-        fb_separator, img_separator = 0, 0
-        card_type = "front"
+        p_media_arg = p_media
+    image_optimizer_arg = ImageOptimizer.from_arg(optimize_images)
+    try:
+        yield
+    finally:
+        p_media_arg, image_optimizer_arg = p_media_arg_outer, image_optimizer_arg_outer
 
-    hint_separator = min([i for i, c in separators if c == "-h"]) if ("-h" in all_separators) else 0
 
-    return (card_type, fb_separator, img_separator, hint_separator)
+def print_read_error() -> str:
+    """
+    Prints the exception currently being handled (and returns its traceback), with advice if it looks like the notebook
+    couldn't be opened
+    """
+    import traceback
+    error = traceback.format_exc()
+    print(error)
+    if "json.decoder.JSONDecodeError: Expecting ',' delimiter" in error:
+        print("There was some kind of error when the notebook was opened. Try restarting kernel, clearing all output, and saving, then running the cell again.")
+    return error
 
 
-### HIGH-LEVEL FUNCTIONS
+# (this is checked at the end of reading a notebook)
+CALL_CELL_ERROR = "Expected exactly one code cell containing an instance of the `read_cards` function, instead found {}.\n\n. See the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
 
-def write_cards_to_anki_package(filename:str, filename_write:Optional[str]=None, write:bool=True, 
-num_cells_below:Optional[Union[str, int]]=None, overwrite=False):
+def iter_card_cells(cells, filename: str, num_cells_below: Optional[Union[int, str]], require_call_cell: bool):
     """
-    Takes filename of current notebook, and writes all cards in the deck to an anki package (.apkg)
-
-    Arguments are:
-        filename
-            the notebook you want to read cards from (must be the same one you're running this function within)
-        filename_write
-            if None, the filename is chosen by appending to `filename`
-            if string, this is chosen as the filename (path can be relative or absolute)
-        write
-            if True, it will write cards to a deck
-            if False, it will print information about the cards (useful for last minute checks)
-        num_cells_below
-            if None (default), it will convert all markdown cells to Anki cards
-            if "all", it will convert all cells below the one you ran this function in
-            if a positive integer, it will convert this many cells below
-        overwrite
-            if True, then the newly created cards will overwrite whatever was stored in that `filename_write` Anki deck before
-            if False, then they won't overwrite, but will instead have a suffix added to their filename (e.g. "_001")
+    Takes the (index, cell_dict) pairs from `iter_notebook_cells`, and yields (deck, cell, images_dict, tags, url, guid,
+    index) for every cell which should be turned into a card (keeping track of the DECK, TAGS and URL meta cells)
     """
+    n = num_cells_below
+    meta_dict = defaultdict(str)
+    num_call_cells, markdown_counter = 0, 0
+    guids, notebook_name = set(), Path(filename).name
 
-    # Do some type-checking
-    if num_cells_below is not None:
-        s = f"Argument {num_cells_below=} should be None, a positive integer, or the string 'all'."
-        n = num_cells_below
-        assert any([(type(n) == int) and (n >= 1), n == "any"]), s
+    for i, cell_dict in cells:
+        # once we've got all the cards we want, we still go through the rest of the cells, to check the code cells
+        if cell_dict["cell_type"] == "markdown" and isinstance(n, int) and markdown_counter == n:
+            continue
+        kind = cell_kind(cell_dict)
 
-    # Reads card dict: keys are decks, values are dicts. Each of these dicts has keys = card types, values = lists of (card contents, tags)-tuples
-    card_dict_by_deck_and_type = read_cards(filename, write, num_cells_below)
+        # find the cell that contains the function you ran (if num_cells_below isn't None, we only want cells below it)
+        if kind == "call":
+            num_call_cells += 1
 
-    for deck, card_dict_by_type in card_dict_by_deck_and_type.items():
+        # update either the deck or tag variables
+        elif kind == "meta":
+            for line in cell_dict["source"]:
+                keyword, value = match_meta(line)
+                meta_dict[keyword] = value
 
-        # Generate a hash to uniquely refer to this deck (has to be the same each time you run this function)
-        h_deck = encode_str(deck)
-        # Create a deck object
-        my_deck = genanki.Deck(
-            deck_id=h_deck,
-            name=deck
-        )
+        elif kind == "card":
+            check_card_meta(meta_dict["deck"], meta_dict["tags"])
+            # Add the card, and increment the counter (you might only be passing a small number of cells through)
+            if n is None or num_call_cells > 0:
+                guid = card_guid(notebook_name, cell_dict, i, guids)
+                yield meta_dict["deck"], cell_dict["source"], cell_dict["attachments"], meta_dict["tags"], meta_dict["url"], guid, i
+                markdown_counter += 1
 
-        for card_type, card_list in card_dict_by_type.items():
+    assert num_call_cells == 1 or (n is None and not require_call_cell), CALL_CELL_ERROR.format(num_call_cells)
 
-            # Generate a hash to uniquely refer to this note type (has to be the same each time you run this function)
-            h_type = encode_str(card_type + "0")
-            # Get the correct fields
-            fields = [{'name': 'Front'}, {'name': 'Hint'}]
-            if card_type in ["front-back", "image"]: fields.insert(1, {'name': 'Back'})
-            # Create a model (equivalent to a note type in Anki)
-            my_model = genanki.Model(
-                model_id=h_type,
-                name=card_type,
-                fields=fields,
-                templates=[{
-                    'name': 'Card 1',
-                    'qfmt': templates_dict[card_type]["front"],
-                    'afmt': templates_dict[card_type]["back"],
-                }],
-                css=templates_dict[card_type]["css"]
-            )
 
-            # Write all the Anki cards to this deck
-            for (fields, tags) in card_list:
-                my_note = genanki.Note(
-                    model=my_model,
-                    fields=fields,
-                    tags=tags
-                )
-                my_deck.add_note(my_note)
-
-        # Get a filename to write to
-        if filename_write is None:
-            filename_write = filename
-        filename_stem = filename_write if not filename_write.endswith(".apkg") else filename_write[:-5]
-        filename_write = filename_stem + f"_{deck=}"
-        filename_write = filename_write.replace("'", "").replace('"', '')
-        if overwrite == False and Path(filename_write + ".apkg").exists():
-            counter = 1
-            while Path(f"{filename_write}_{counter:02}.apkg").exists():
-                counter += 1
-            filename_write = f"{filename_write}_{counter:02}.apkg"
-
-        # Write the cards
-        genanki.Package(my_deck).write_to_file(filename_write + ".apkg")
+def check_card_meta(deck: str, tags: str) -> None:
+    """
+    Checks the deck and tags in effect at a card
+    """
+    # If the cell doesn't have a deck (or deck name is blank), raise an exception
+    if deck == "":
+        raise Exception("One of your cards doesn't seem to have a deck. You can specify deck by adding a markdown cell containing the text:\n\nDECK = [deck-name]")
+    # If the cell doesn't have a tag (or tag is blank), print a warning
+    if tags == "":
+        print("Reminder - some of your cards don't have tags. You can add tags by putting a markdown cell with `TAGS = ...` before your cards.\n")
 
 
-def match_meta(s):
+def card_guid(notebook_name: str, cell_dict: Dict, i: int, guids: set) -> str:
     """
-    Useful shorthand, returns boolean for whether this line of the cell is a meta line
+    The GUID of the note made from cell i of a notebook (`guids` is the set of GUIDs of the cards before it, which this
+    one gets added to)
     """
-    for keyword in ["tags", "deck", "url"]:
-        if re.match(f"{keyword}\s*=\s*", s, re.IGNORECASE):
-            return keyword, re.sub(f"{keyword}\s*=\s*", "", s, flags=re.IGNORECASE).strip()
-    return False
+    import genanki
+    # the note's GUID comes from the notebook name and cell id, so it stays the same when the card is edited (or the
+    # notebook is moved), although this means copies of a notebook have the same GUIDs (see `check_guid_collisions`)
+    # (older notebooks don't have cell ids, so we fall back to the cell's contents)
+    cell_id = cell_dict["id"]
+    guid = genanki.guid_for(notebook_name, cell_id if cell_id is not None else "".join(cell_dict["source"]))
+    if guid in guids:
+        guid = genanki.guid_for(notebook_name, cell_id, i)
+    guids.add(guid)
+    return guid
 
 
-def read_cards(filename:str, write:bool, num_cells_below:Optional[Union[int, str]]):
+def iter_rendered_cards(card_cells, render_cache: Optional[RenderCache], workers: Optional[int], batch_size: int = 16):
     """
-    Opens a Jupyter Notebook given by filename, reads all the cards in non-tag markdown cells, and writes them (separated by note type) to a text file
-    
-    INPUTS
-        filename        | should be name of notebook you're converting to Anki (ideally the current notebook)
-        write           | if false, it doesn't write cards to an `.apkg` file (only do True when you're sure you're done with the cards)
-        num_cells_below | None => writes every cell (default), "all" => writes all cells below, int => num cells below
+    Takes the cards from `iter_card_cells`, and yields (card_data, result) for each one in order, where result is what
+    `render_single_card` returns. Cards which are in the render cache aren't rendered again.
+
+    If `workers` is more than 1, cards are rendered in batches in a process pool. At most two batches per worker are in
+    flight at once, so only a bounded number of cards (and their attachments) are held in memory. Images are written in the
+    background while we render, and worker processes wait for each card's images before returning it (so that they can
+    report any which couldn't be written).
     """
+    # cards waiting to be yielded, as [card_data, cache key, result] (result is None until the card has been rendered)
+    pending = deque()
+    batch, in_flight = [], deque()
+    executor = None
 
-    # get global error messages (to print at the end)
-    global error_messages
-    error_messages = []
+    def submit():
+        nonlocal batch, executor
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=workers)
+        future = executor.submit(render_cards, [(entry[0][1], entry[0][2], p_media_arg, True, image_optimizer_arg) for entry in batch])
+        in_flight.append((future, batch))
+        batch = []
 
-    # if filename includes a stem, deal with this
-    if not filename.endswith(".ipynb"):
-        filename += ".ipynb"
-    
-    # initialises these variables so that in the event of an error they can be returned, which helps me to do bug-fixing
-    soup, cells_json_dict_list = None, None
-    markdown_cells_dict, cards_processed_dict, meta_dict = defaultdict(list), defaultdict(lambda: defaultdict(list)), defaultdict(str)
+    def collect():
+        future, entries = in_flight.popleft()
+        for entry, result in zip(entries, future.result()):
+            entry[2] = result
+            if render_cache is not None: render_cache.put(entry[1], *result[:3])
 
     try:
-    
-        with open(filename, encoding="utf_8") as f:
-            
-            # read notebook, check if there are any classes in the notebook, and if so then removes them (this can fuck with the json loading)
-            soup = BeautifulSoup(f, "html.parser", from_encoding="utf_8")
-            soup = BeautifulSoup(soup.text, "html.parser")
-            
-        # get the notebook data in the form of a dictionary, and also get all the attachments
-        cells_json_dict_list = json.loads(soup.decode_contents())["cells"]
-        markdown_cells = [(i, cell_dict["source"]) for i, cell_dict in enumerate(cells_json_dict_list) if cell_dict["cell_type"] == "markdown"]
-        code_cells = [(i, cell_dict["source"]) for i, cell_dict in enumerate(cells_json_dict_list) if cell_dict["cell_type"] == "code"]
-        images = [cell_dict.get("attachments", {}) for cell_dict in cells_json_dict_list if cell_dict["cell_type"] == "markdown"]
+        for card_data in card_cells:
+            deck, card, images_dict, tags, url, guid, i = card_data
+            key, result = None, None
+            if render_cache is not None:
+                key = RenderCache.key(card, images_dict, deck, tags, url, image_optimizer_arg)
+                result = render_cache.get(key)
+                if result is not None:
+                    result = (*result, (0.0, 0, 0, {}))
+            if result is None and (workers is None or workers <= 1):
+                result = render_single_card(card, images_dict, p_media_arg, image_optimizer=image_optimizer_arg)
+                if render_cache is not None: render_cache.put(key, *result[:3])
+            pending.append([card_data, key, result])
+            if result is None:
+                batch.append(pending[-1])
+                if len(batch) == batch_size:
+                    submit()
 
-        # do some type checking of arguments
-        n = num_cells_below
-        assert any([n is None, n == "all", (isinstance(n, int) and n >= 1)]), f"{num_cells_below = }, this is not allowed. Expected values are `None`, 'all' or positive integer.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
-
-        # find the cell that contains the function you ran, and find the next markdown cell (needed for determining which cells to Ankify)
-        write_cards_cells = [i for i, c in code_cells if any("write_cards_to_anki_package(" in line for line in c)]
-        assert len(write_cards_cells) == 1, f"Expected exactly one code cell containing an instance of the `read_cards` function, instead found {len(write_cards_cells)}.\n\n. See the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
-        write_cards_cell = write_cards_cells[0]
-        first_markdown = 0 if n is None else min([i for i, c in markdown_cells if i > write_cards_cell])
-        markdown_counter = 0
-
-        # loop through the cells and images, and sort the Anki cards into a dictionary by tag & url
-        for (i, cell), images_dict in zip(markdown_cells, images):
-
-            # update either the deck or tag variables
-            if len(cell) == len([line for line in cell if match_meta(line)]):
-                for line in cell:
-                    keyword, value = match_meta(line)
-                    meta_dict[keyword] = value
-
-            # A markdown cell is Anki iff it doesn't start w/ a header
-            elif (not cell[0].startswith("#")):
-                # If the cell doesn't have a deck (or deck name is blank), raise an exception
-                if meta_dict["deck"] == "":
-                    raise Exception("One of your cards doesn't seem to have a deck. You can specify deck by adding a markdown cell containing the text:\n\nDECK = [deck-name]")
-                # If the cell doesn't have a tag (or tag is blank), print a warning
-                if meta_dict["tags"] == "":
-                    print("Reminder - some of your cards don't have tags. You can add tags by putting a markdown cell with `TAGS = ...` before your cards.\n")
-                # Add the card, and increment the counter (you might only be passing a small number of cells through)
-                if i >= first_markdown:
-                    card_data = (cell, images_dict, meta_dict["tags"], meta_dict["url"])
-                    markdown_cells_dict[meta_dict["deck"]].append(card_data)
-                    markdown_counter += 1
-                    if isinstance(n, int) and markdown_counter == n:
-                        break
+            # yield the cards at the front of the queue which are ready (waiting for batches if there are too many in flight)
+            while pending and (pending[0][2] is not None or (in_flight and (in_flight[0][0].done() or len(in_flight) >= 2 * workers))):
+                if pending[0][2] is None:
+                    collect()
+                else:
+                    card_data, _, result = pending.popleft()
+                    yield card_data, result
 
-        # get a dictionary of cards, sorted by the card type (and print out samples of the card)
-        for deck, card_data in markdown_cells_dict.items():
-            for card, images_dict, tags, url in card_data:
-                card_type, card_content = read_single_card(card, images_dict)
-                cards_processed_dict[deck][card_type].append((card_content, tags.split(" ")))
-            # if write: print(f"\t{len(markdown_cells_dict[tags])} cards with {deck = }, {tags = }")
-        
-        # A global error message capture method (for things like potentially bad formatting in the cards, to warn the user about)
-        if len(error_messages) > 0:
-            print("\n======== ERROR MESSAGES ========\n")
-            for msg in error_messages: print(msg)
-    
-    # Exceptions here usually mean the notebook hasn't been properly cleared (e.g. images or printed output can mess with it)
-    except:
-        error = traceback.format_exc()
-        print(error)
-        if "json.decoder.JSONDecodeError: Expecting ',' delimiter" in error:
-            print("There was some kind of error when the notebook was opened. Try restarting kernel, clearing all output, and saving, then running the cell again.")
+        # render whatever's left (a single card isn't worth starting a process pool for)
+        if len(batch) == 1 and executor is None:
+            entry = batch.pop()
+            entry[2] = render_single_card(entry[0][1], entry[0][2], p_media_arg, image_optimizer=image_optimizer_arg)
+            if render_cache is not None: render_cache.put(entry[1], *entry[2][:3])
+        elif batch:
+            submit()
+        while pending:
+            if pending[0][2] is None:
+                collect()
+            else:
+                card_data, _, result = pending.popleft()
+                yield card_data, result
 
-    return cards_processed_dict
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def render_cards(cards: List[Tuple[List[str], Dict, Optional[str], bool, Optional[ImageOptimizer]]]) -> List[Tuple]:
+    """
+    Renders a batch of cards (each one is the arguments of `render_single_card`), for a worker process
+    """
+    return [render_single_card(*args) for args in cards]
+
+
+def render_single_card(card: List[str], images_dict: Dict, p_media: Optional[str] = None, wait_for_media: bool = False, image_optimizer: Optional[ImageOptimizer] = None) -> Tuple[str, List[str], List[str], Tuple[float, int, int, Dict[str, str]]]:
+    """
+    Renders a single card, returning (card_type, fields, warnings, (seconds, bytes of media written, bytes saved by
+    optimising images, images which couldn't be written)). Everything is collected per card (rather than in a global) so
+    that this can be run in worker processes, and the results gathered back up in order. The media folder and image
+    optimiser are passed in for the same reason.
+
+    The card's images are written in the background, so the media stats are only filled in if `wait_for_media` is True
+    (which is what worker processes do, since nothing else in the process will wait for them).
+    """
+    global p_media_arg, image_optimizer_arg
+    warnings_outer, p_media_arg_outer, image_optimizer_arg_outer = getattr(render_state, "warnings", None), p_media_arg, image_optimizer_arg
+    render_state.warnings, p_media_arg, image_optimizer_arg = [], p_media, image_optimizer
+    try:
+        media_store = get_media_store()
+        bytes_written, bytes_saved = media_store.bytes_written, media_store.bytes_saved
+        t0 = time.perf_counter()
+        card_type, fields = read_single_card(card, images_dict)
+        seconds, failures = time.perf_counter() - t0, {}
+        if not wait_for_media:
+            bytes_written = bytes_saved = 0
+        else:
+            media_failures = media_store.wait()
+            bytes_written, bytes_saved = media_store.bytes_written - bytes_written, media_store.bytes_saved - bytes_saved
+            failures = {img_name: media_failures[img_name] for field in fields for img_name in IMG_SRC_REGEX.findall(field) if img_name in media_failures}
+        return card_type, fields, render_state.warnings, (seconds, bytes_written, bytes_saved, failures)
+    finally:
+        render_state.warnings, p_media_arg, image_optimizer_arg = warnings_outer, p_media_arg_outer, image_optimizer_arg_outer
 
 
 def read_single_card(card: List[str], images_dict: Dict) -> Tuple[str, str]:
@@ -283,7 +2201,123 @@ def read_single_card(card: List[str], images_dict: Dict) -> Tuple[str, str]:
     return (card_type, fields)
 
 
-def read_single_field(field: List, images_dict: Dict) -> str:
+OL_LINE_REGEX = re.compile("\\d{1,2}\\. ")
+IMAGE_LINE_REGEX = re.compile("!\\[(.*)\\]")
+IMAGE_NAME_REGEX = re.compile("!\\[(.*?)\\]")
+BR_REPLACE_REGEX_LIST = [(re.compile(key), value) for key, value in {"(<br>)+<ul>": "<ul>", "</ul>(<br>)+": "</ul>", "(<br>)+<ol>": "<ol>", "</ol>(<br>)+": "</ol>", "</pre></div><br><br>": "</pre></div><br>", "</div><br><br>": "</div><br>"}.items()]
+
+def tokenize_field(field: List[str]) -> Dict[str, list]:
+    """
+    Finds the position of every quotebox, codeblock, list and image in a field, in a single pass over its lines.
+
+    Returns a dict with the same conventions as the index lists in `read_single_field_reference` (end indices are the last
+    line of the block, and lists / codeblocks are given as (start, end) tuples).
+    """
+    tokens = {"ul": [], "ol": [], "codeblock": [], "quotebox": [], "image": []}
+    quotebox_indices_temp = []
+    codeblock_start, codeblock_end = None, None
+    ul_start, ol_start = None, None
+
+    for i, c in enumerate(field):
+        stripped = c.strip()
+
+        # (Q) splits up the quotebox into sections, and a blank line (or the end of the field) finishes it
+        if stripped == "(Q)":
+            quotebox_indices_temp.append(i)
+        if stripped == "" or i == len(field) - 1:
+            if len(quotebox_indices_temp) > 0:
+                tokens["quotebox"].append(tuple(quotebox_indices_temp))
+                assert len(quotebox_indices_temp) in [2, 3], f"Your quoteboxes must contain either 2 or 3 (Q)'s, but this one contains {len(quotebox_indices_temp)}.\n\nSee the documentation pages for more detail:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
+            quotebox_indices_temp = []
+
+        # codeblock lines separated by at most one other line belong to the same codeblock
+        if c.startswith("    ") and stripped != "":
+            if codeblock_start is not None and i - codeblock_end > 2:
+                tokens["codeblock"].append((codeblock_start, codeblock_end))
+                codeblock_start = None
+            if codeblock_start is None:
+                codeblock_start = i
+            codeblock_end = i
+
+        # list items have to be on consecutive lines to belong to the same list
+        if c.startswith("* "):
+            if ul_start is None:
+                ul_start = i
+        elif ul_start is not None:
+            tokens["ul"].append((ul_start, i - 1))
+            ul_start = None
+        if OL_LINE_REGEX.match(c):
+            if ol_start is None:
+                ol_start = i
+        elif ol_start is not None:
+            tokens["ol"].append((ol_start, i - 1))
+            ol_start = None
+
+        if IMAGE_LINE_REGEX.match(c):
+            tokens["image"].append(i)
+
+    if codeblock_start is not None:
+        tokens["codeblock"].append((codeblock_start, codeblock_end))
+    if ul_start is not None:
+        tokens["ul"].append((ul_start, len(field) - 1))
+    if ol_start is not None:
+        tokens["ol"].append((ol_start, len(field) - 1))
+
+    return tokens
+
+
+def read_single_field(field: List, images_dict: Dict, reference: bool = False) -> str:
+    """
+    Converts the lines of a single field into HTML: first the blocks (lists, codeblocks, quoteboxes and images), then the
+    inline markdown.
+
+    If `reference=True`, the blocks are compiled by the original (quadratic) implementation, which is kept around for
+    differential testing. Both give exactly the same HTML.
+    """
+    if reference:
+        return markdown_to_html_ignoring_codeblock(compile_blocks_reference(field, images_dict))
+    return markdown_to_html_ignoring_codeblock(compile_blocks(field, images_dict))
+
+
+def compile_blocks(field: List, images_dict: Dict) -> str:
+    """
+    Converts the blocks in a field into HTML, in linear time.
+
+    The blocks are found by `tokenize_field`, then each one is written over the lines it covers (with "XXX" padding the
+    lines after the first, so that indices don't move), and the lines are joined with line breaks.
+    """
+
+    # remove the line breaks at the end of lines
+    field = [line.rstrip() for line in field]
+    tokens = tokenize_field(field)
+
+    # the blocks are built in the same order as in the reference implementation, because later ones can contain earlier
+    # ones (e.g. a list inside a quotebox), and are built from the lines after those have been replaced
+    for list_type in ["ul", "ol"]:
+        for start, end in tokens[list_type]:
+            field[start] = f"<{list_type}>" + "".join(f"<li>{line[2:]}</li>" for line in field[start:end + 1]) + f"</{list_type}>"
+            field[start + 1:end + 1] = ["XXX"] * (end - start)
+    for start, end in tokens["codeblock"]:
+        field[start] = build_codeblock(field, (start, end))
+        field[start + 1:end + 1] = ["XXX"] * (end - start)
+    for quotebox_indices in tokens["quotebox"]:
+        field[quotebox_indices[0]] = build_quotebox(field, quotebox_indices)
+        field[quotebox_indices[0] + 1:quotebox_indices[-1] + 1] = ["XXX"] * (quotebox_indices[-1] - quotebox_indices[0])
+    for image_index in tokens["image"]:
+        field[image_index] = build_image_line(field[image_index], images_dict)
+
+    # remove the "XXX" padding, join it all together, and remove the line breaks which we don't actually want
+    field = "<br>".join([line.replace("XXX", "") for line in field if line != "XXX"])
+    for regex, value in BR_REPLACE_REGEX_LIST:
+        field = regex.sub(value, field)
+
+    return field
+
+
+def compile_blocks_reference(field: List, images_dict: Dict) -> str:
+    """
+    The original implementation of `compile_blocks`, which is quadratic in the length of the field.
+    """
 
     # general convention: my end indices are the last line on which the thing appears, so the actual slices are often [start_idx : end_idx + 1]
     indices_dict = {}
@@ -376,10 +2410,8 @@ def read_single_field(field: List, images_dict: Dict) -> str:
     replace_dict = {"(<br>)+<ul>": "<ul>", "</ul>(<br>)+": "</ul>", "(<br>)+<ol>": "<ol>", "</ol>(<br>)+": "</ol>", "</pre></div><br><br>": "</pre></div><br>", "</div><br><br>": "</div><br>"}
     for key, value in replace_dict.items():
         field = re.sub(key, value, field)
-    
-    # ============== CONVERT MARKDOWN TO HTML ==============
-    
-    return markdown_to_html_ignoring_codeblock(field)
+
+    return field
 
 
 ### LOW-LEVEL FUNCTIONS
@@ -468,29 +2500,116 @@ def build_image_line(s: str, img_name_dict: Dict) -> str:
     Note, this now deals with lines that have more than one image.
     """
 
-    img_names = re.findall("!\[(.*?)\]", s)
+    img_names = IMAGE_NAME_REGEX.findall(s)
     s = ""
     
     for img_name in img_names:
-        
-        filetype = "gif" if img_name.endswith(".gif") else "jpg"
     
         assert img_name in img_name_dict, f"img_name_orig ({img_name}) not in img_name_dict: {list(img_name_dict.keys())}.\n\nThis probably happened because you copied or uploaded or named an image in your notebook in a weird way.\n\nIf you can't fix this problem, please contact me at my GitHub page:\n\nhttps://github.com/callummcdougall/jupyter-to-anki/blob/main/README.md"
-        img_code = list(img_name_dict[img_name].values())[0]    # json data (needs to be decoded to write to a file)
-        img_name_new = get_filename_from_json_data(img_code, filetype=filetype)   # hash of the data, so it has a unique filename
-
-        with open(p_media / img_name_new, 'wb') as f:
-            f.write(base64.b64decode(img_code))
-            # print(f"{img_name_orig} written to collections.media")
+        mime_type, img_code = list(img_name_dict[img_name].items())[0]    # json data (needs to be decoded to write to a file)
+        # the magic bytes at the start of the data are the most reliable way to tell the format
+        filetype = sniff_filetype(img_code) or MIME_FILETYPES.get(mime_type, "gif" if img_name.endswith(".gif") else "jpg")
+        img_name_new = get_media_store().add(img_code, filetype)
 
         s += f"<img src='{img_name_new}'>"
     
     return s
 
-def markdown_to_html_ignoring_codeblock(s: str) -> str:
+CODEBLOCK_OPEN, CODEBLOCK_CLOSE = "<div class='exerciseprecontainer'><pre>", "</pre></div>"
+CODEBLOCK_REGEX = re.compile(re.escape(CODEBLOCK_OPEN) + "(.{5,}?)" + re.escape(CODEBLOCK_CLOSE))
+CODELINE_PLACEHOLDER_REGEX = re.compile("\x00(\\d+)\x00")
+CODEBLOCK_PLACEHOLDER = "\x00" * 4
+# characters which could make it matter which occurrence of a code span's text gets protected (see below)
+CODELINE_SENSITIVE_REGEX = re.compile("[*()\\\\<>]")
+# used to expand backslash escapes in code, in the same way `re.sub` did when code was put back in from placeholders
+EMPTY_MATCH = re.match("", "")
+INLINE_MARKDOWN_LIST = [
+    ("**", "bold", "<b>", "</b>"),
+    ("*", "italic", "<i>", "</i>"),
+    ("`", "code font", "<font color='#ff5500'>", "</font>"),
+    ("(S)", "a spoiler", "<span class='spoiler'>", "</span>"),
+]
+
+def expand_escapes(s: str) -> str:
+    return EMPTY_MATCH.expand(s) if "\\" in s else s
+
+def markdown_to_html_ignoring_codeblock(s: str, reference: bool = False) -> str:
     """
     Makes substitutions like *...* -> <i>...</i> (other ones are bold and codefont)
     Doesn't affect code blocks
+
+    This scans the string a fixed number of times, so it takes linear time (and there's no limit on the number of code
+    blocks or code spans). It gives the same output as `markdown_to_html_ignoring_codeblock_reference` (which you get with
+    `reference=True`), including its quirks:
+        * everything from the first codeblock's content to the last codeblock's content is left alone
+        * all text between two consecutive backticks is left alone if it's at least 5 characters long (whether or not
+          it's actually inside a code span)
+        * backslash escapes in the text which is left alone are expanded (e.g. "\\n" becomes a newline)
+    The one exception is when the codeblocks are between two backticks (e.g. a code span before and after them), in which
+    case the reference version loses the code (it shows up as "&B00"), whereas this keeps it.
+    """
+    # the rare cases which depend on the exact way the reference version used placeholders are passed on to it
+    if reference or "\n" in s:
+        return markdown_to_html_ignoring_codeblock_reference(s)
+    s_original = s
+
+    # first, swap the codeblocks out for a placeholder (the reference version ends up merging all of them into one, and it
+    # expands escapes separately in the parts of this region which end at a closing tag, so that's replicated here)
+    codeblock_region = None
+    srch = CODEBLOCK_REGEX.search(s)
+    if srch:
+        start, end = srch.span(1)
+        # (the reference version replaces the first occurrence of this text, which isn't always the one in the codeblock)
+        if s.find(srch.group(1)) < start:
+            return markdown_to_html_ignoring_codeblock_reference(s)
+        codeblock_parts = []
+        part_start = start
+        while end != -1:
+            codeblock_parts.append(expand_escapes(s[part_start:end]))
+            part_start, end = end, s.find(CODEBLOCK_CLOSE, end + 1)
+        codeblock_region = "".join(codeblock_parts)
+        s = s[:start] + CODEBLOCK_PLACEHOLDER + s[part_start:]
+
+    # second, swap out the text between consecutive backticks (if it's long enough) for placeholders
+    codeline_list = []
+    backtick_indices = [m.start() for m in re.finditer("`", s)]
+    if len(backtick_indices) >= 2:
+        s_parts = []
+        prev = 0
+        for i, j in zip(backtick_indices, backtick_indices[1:]):
+            if j - i > 5:
+                codeline = s[i + 1:j]
+                # (same as above, if this text appears before the first backtick then the reference version swaps that out)
+                if CODELINE_SENSITIVE_REGEX.search(codeline) and s.find(codeline, 0, backtick_indices[0]) != -1:
+                    return markdown_to_html_ignoring_codeblock_reference(s_original)
+                s_parts.append(s[prev:i + 1] + f"\x00{len(codeline_list)}\x00")
+                codeline_list.append(expand_escapes(codeline))
+                prev = j
+        s = "".join(s_parts) + s[prev:]
+
+    # now that these have been extracted, you can make all the normal markdown -> html swaps
+    # also if there's an odd number of any of these then another one is added (at the first line break, or the end)
+    for k, word, html_open, html_close in INLINE_MARKDOWN_LIST:
+        if s.count(k) % 2 == 1:
+            warn(f"We found a single '{k}'-character in one one of the lines of your card. This will be interpreted as {word} by the Python code, and they should come in even numbers. If you don't fix this error then it might mess up your card.")
+            break_point = s.find("<br>", 0, len(s) - 1)
+            s = s + k if break_point == -1 else s[:break_point] + k + s[break_point:]
+        s_parts = s.split(k)
+        if len(s_parts) > 1:
+            s = s_parts[0] + "".join((html_close if i % 2 else html_open) + part for i, part in enumerate(s_parts[1:]))
+
+    # finally, add back in the codelines and codeblocks
+    if codeline_list:
+        s = CODELINE_PLACEHOLDER_REGEX.sub(lambda m: codeline_list[int(m.group(1))], s)
+    if codeblock_region is not None:
+        s = s.replace(CODEBLOCK_PLACEHOLDER, codeblock_region)
+
+    return s
+
+
+def markdown_to_html_ignoring_codeblock_reference(s: str) -> str:
+    """
+    The original implementation of `markdown_to_html_ignoring_codeblock`, which rescans the string for every replacement.
     """
     
     # first, extract all of the codeblocks and codelines (because we don't want those asterisks to be removed)
@@ -518,8 +2637,7 @@ def markdown_to_html_ignoring_codeblock(s: str) -> str:
         num_matches = len(re.findall(k, s))
         if num_matches % 2 == 1:
             k_ = k.replace('\\', '')
-            global error_messages
-            error_messages.append(f"We found a single '{k_}'-character in one one of the lines of your card. This will be interpreted as {replace_dict_words[k_]} by the Python code, and they should come in even numbers. If you don't fix this error then it might mess up your card.")
+            warn(f"We found a single '{k_}'-character in one one of the lines of your card. This will be interpreted as {replace_dict_words[k_]} by the Python code, and they should come in even numbers. If you don't fix this error then it might mess up your card.")
             break_points = [i for i in range(len(s)-4) if s[i:i+4] == "<br>"]
             if len(break_points) == 0:
                 s += k_
@@ -542,3 +2660,418 @@ def markdown_to_html_ignoring_codeblock(s: str) -> str:
         s = re.sub(placeholder_string, codeline_content, s)
         
     return s
+
+
+
+### LINT
+
+SEPARATORS = ["-", "-i", "-h"]
+BACKTICK_REGEX = re.compile("`")
+# quick check for lines which might be meta lines (most lines aren't, so this saves calling `match_meta` on every line)
+META_PREFIX_REGEX = re.compile("(?:tags|deck|url)\\s*=", re.IGNORECASE)
+
+class LintDiagnostic(NamedTuple):
+    """
+    A problem found by `lint_notebook`. `cell` is the index of the cell in the notebook (counting from 0, as in
+    `BuildReport`) and `line` is the line in the cell (counting from 1), and either can be None if the problem isn't in a
+    particular cell or line. `severity` is "error" for things which stop the notebook being turned into cards or change
+    what ends up in them, and "warning" for things which the renderer warns about (or which are probably mistakes).
+    """
+    filename: str
+    cell: Optional[int]
+    line: Optional[int]
+    severity: str
+    code: str
+    message: str
+
+    def __str__(self) -> str:
+        location = [f"{k} {v}" for k, v in [("cell", self.cell), ("line", self.line)] if v is not None]
+        return ":".join([self.filename, *location, f" {self.severity} [{self.code}] {self.message}"])
+
+
+def lint_card(card: List[str], images_dict: Dict) -> List[Tuple[int, str, str, str]]:
+    """
+    Checks the lines of a single card, returning (line index, severity, code, message) for each problem. These are the same
+    checks as `get_card_type_and_hint`, `tokenize_field`, `markdown_to_html_ignoring_codeblock` and `build_image_line` make,
+    but nothing is rendered.
+    """
+    problems = []
+    stripped = [line.strip() for line in card]
+
+    # lines which look like meta lines don't do anything in a card (the whole cell has to be meta lines), although they
+    # could also just be part of the card, so this is only a warning
+    for i, line in enumerate(card):
+        meta = META_PREFIX_REGEX.match(line) and match_meta(line)
+        if meta:
+            problems.append((i, "warning", "meta-in-card", f"This cell is read as a card, so this line doesn't set the {meta[0]} (every line of a DECK / TAGS / URL cell has to be a meta line, including blank lines)."))
+
+    # separators (lines starting with "-"), and the blank lines around them which `read_single_card` leaves out
+    separators = [i for i, c in enumerate(stripped) if c.startswith("-")]
+    for i in separators:
+        if stripped[i] not in SEPARATORS:
+            problems.append((i, "error", "bad-separator", f"The only allowed separators (lines starting with '-') are '-' (for front/back), '-i' (for image cards) and '-h' (for hints), instead found {stripped[i]!r}."))
+    if len(separators) > 2:
+        problems.append((separators[2], "error", "too-many-separators", f"There should be at most 2 separators (lines starting with '-') in a card, instead found {len(separators)}."))
+    separators = [i for i in separators if stripped[i] in SEPARATORS]
+    kinds = [stripped[i] for i in separators]
+    if len(kinds) == 2 and (kinds[0] == kinds[1] or "-h" not in kinds or kinds[0] == "-h"):
+        problems.append((separators[1], "warning", "separator-order", f"A card can have one '-' or '-i' separator, followed by one '-h' separator, instead found {kinds}."))
+    for i in separators:
+        for j in [i - 1, i + 1]:
+            if 0 <= j < len(card) and stripped[j] != "":
+                problems.append((j, "error", "separator-spacing", "This line will be missing from the card, because there should be a blank line before and after each separator."))
+        if i == 0:
+            problems.append((i, "error", "separator-spacing", "A card can't start with a separator."))
+
+    # quoteboxes and inline markdown are checked in each field separately (as they're rendered)
+    bounds = [-1] + separators + [len(card)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        field = [(i, card[i].rstrip()) for i in range(start + 1, end)]
+        quotebox = []
+        for i, line in field:
+            if stripped[i] == "(Q)":
+                quotebox.append(i)
+            if stripped[i] == "" or i == end - 1:
+                if len(quotebox) not in [0, 2, 3]:
+                    problems.append((quotebox[0], "error", "quotebox", f"Your quoteboxes must contain either 2 or 3 (Q)'s, but this one contains {len(quotebox)}."))
+                quotebox = []
+        # the renderer leaves codeblocks alone (and everything between the first and last one)
+        code_lines = [i for i, line in field if line.startswith("    ")]
+        text = [
+            (i, line[2:] if line.startswith("* ") else line) for i, line in field
+            if not (code_lines and code_lines[0] <= i <= code_lines[-1]) and stripped[i] != "(Q)" and not IMAGE_LINE_REGEX.match(line)
+        ]
+        unbalanced = find_unbalanced_markdown(text)
+        for k, word, *_ in INLINE_MARKDOWN_LIST:
+            if k in unbalanced:
+                problems.append((unbalanced[k], "warning", "unbalanced-markdown", f"We found a single '{k}'-character in this field. This will be interpreted as {word}, and they should come in even numbers."))
+
+    # every image has to be attached to the cell
+    for i, line in enumerate(card):
+        if IMAGE_LINE_REGEX.match(line):
+            for img_name in IMAGE_NAME_REGEX.findall(line):
+                if img_name not in images_dict:
+                    problems.append((i, "error", "missing-attachment", f"The image {img_name!r} isn't attached to this cell (attachments are {list(images_dict)})."))
+
+    return sorted(problems, key=lambda problem: problem[0])
+
+
+def find_unbalanced_markdown(lines: List[Tuple[int, str]]) -> Dict[str, int]:
+    """
+    Takes the (index, line) pairs of the text in a field, and returns the inline markdown markers which don't come in pairs
+    (mapped to the index of the line where the unpaired one was opened). Like `markdown_to_html_ignoring_codeblock`, this
+    counts over the whole field, and ignores the text between two backticks if it's at least 5 characters long.
+    """
+    text = "<br>".join(line for _, line in lines)
+    # hide the text between backticks, keeping everything else in the same place
+    backticks = [m.start() for m in BACKTICK_REGEX.finditer(text)]
+    parts, prev = [], 0
+    for i, j in zip(backticks, backticks[1:]):
+        if j - i > 5:
+            parts.append(text[prev:i + 1] + "\x00" * (j - i - 1))
+            prev = j
+    text = "".join(parts) + text[prev:]
+    text_without_bold = text.replace("**", "")
+    if not any(num % 2 for num in [text.count("**"), text_without_bold.count("*"), text.count("`"), text_without_bold.count("(S)")]):
+        return {}
+
+    # if they don't all come in pairs, we go through line by line to find out where the unpaired ones are
+    unbalanced, pos = {}, 0
+    for index, line in lines:
+        line, pos = text[pos:pos + len(line)], pos + len(line) + 4
+        # (this is the same order the markers are replaced in, so e.g. "**" isn't counted as two "*"s)
+        line_without_bold = line.replace("**", "")
+        counts = [line.count("**"), line_without_bold.count("*"), line.count("`"), line_without_bold.count("(S)")]
+        for (k, *_), num in zip(INLINE_MARKDOWN_LIST, counts):
+            if num % 2 == 1:
+                # markers can be closed on a later line of the field, so we keep track of where the open one is
+                unbalanced[k] = None if unbalanced.get(k) is not None else index
+    return {k: index for k, index in unbalanced.items() if index is not None}
+
+
+def lint_notebook(filename: Union[str, Path]) -> List[LintDiagnostic]:
+    """
+    Checks the cards in a notebook without rendering them (or writing any images or packages), and returns the problems
+    found. This is much faster than building the notebook, so it's useful for things like pre-commit hooks.
+
+    It checks that every card has a deck and tags, that meta cells only contain meta lines, that separators are valid and
+    have blank lines around them, that quoteboxes have 2 or 3 (Q)'s, that bold / italic / code font / spoiler markers come
+    in pairs, and that every image is attached to its cell.
+    """
+    filename = str(filename)
+    diagnostics = []
+    meta_dict = defaultdict(str)
+    checked_meta = set()
+    try:
+        with open(filename, "rb") as f:
+            # (this reads the notebook in the same way as `iter_notebook_cells`, but without cleaning any HTML)
+            for i, (_, _, cell_dict) in enumerate(NotebookCellStream(f)):
+                if cell_dict.get("cell_type") != "markdown":
+                    continue
+                cell = cell_dict.get("source", [])
+                if isinstance(cell, str):
+                    cell = cell.splitlines(True)
+                if all(META_PREFIX_REGEX.match(line) for line in cell) and all(match_meta(line) for line in cell):
+                    meta_dict.update(match_meta(line) for line in cell)
+                    continue
+                if cell[0].startswith("#"):
+                    continue
+                # (missing decks and tags are only reported for the first card they're missing from)
+                for keyword, severity, message in [
+                    ("deck", "error", "This card doesn't have a deck. You can specify the deck by adding a markdown cell above it containing `DECK = [deck-name]`."),
+                    ("tags", "warning", "This card doesn't have tags. You can add tags by putting a markdown cell with `TAGS = ...` before your cards."),
+                ]:
+                    if meta_dict[keyword] == "" and keyword not in checked_meta:
+                        checked_meta.add(keyword)
+                        diagnostics.append(LintDiagnostic(filename, i, None, severity, f"no-{keyword}", message))
+                for j, severity, code, message in lint_card(cell, cell_dict.get("attachments", {})):
+                    diagnostics.append(LintDiagnostic(filename, i, j + 1, severity, code, message))
+    except (OSError, ValueError) as e:
+        diagnostics.append(LintDiagnostic(filename, None, None, "error", "invalid-notebook", f"Couldn't read the notebook ({type(e).__name__}: {e})."))
+    return diagnostics
+
+
+def lint_notebooks(paths: List[str], workers: Optional[int] = None) -> List[LintDiagnostic]:
+    """
+    Runs `lint_notebook` on every notebook in the given paths (notebooks, or directories to search recursively), in a pool
+    of `workers` processes (by default one per CPU, or none if there's only one notebook). Returns all the problems found,
+    in the same order as the notebooks.
+    """
+    notebooks = find_notebooks(paths)
+    workers = min(workers or os.cpu_count() or 1, len(notebooks))
+    if workers <= 1:
+        return [diagnostic for notebook in notebooks for diagnostic in lint_notebook(notebook)]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lint_notebook, notebooks, chunksize=max(1, len(notebooks) // (4 * workers)))
+        return [diagnostic for diagnostics in results for diagnostic in diagnostics]
+
+
+
+### WATCH MODE
+
+# inotify constants (from <sys/inotify.h>)
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+INOTIFY_EVENT_HEADER_SIZE = 16
+
+class NotebookWatcher:
+    """
+    Waits for notebooks to be saved. On Linux this uses inotify (watching the folders the notebooks are in, since Jupyter
+    saves by writing a new file and renaming it), and everywhere else (or if `poll=True`) it polls the notebooks' mtimes.
+
+    Saves often come in bursts (e.g. autosave plus a checkpoint), so `wait` only returns once no notebook has changed
+    for `debounce` seconds.
+    """
+    def __init__(self, paths: List[Union[str, Path]], debounce: float = 0.3, poll: bool = False, poll_interval: float = 0.5):
+        self.paths = {Path(path).resolve() for path in paths}
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.fd = None
+        if not poll:
+            self.fd = self.inotify_init()
+        if self.fd is None:
+            self.mtimes = {path: self.mtime(path) for path in self.paths}
+
+    def inotify_init(self) -> Optional[int]:
+        """
+        Sets up an inotify watch on every folder containing a notebook, and returns the file descriptor (or None if
+        inotify isn't available, in which case we poll instead)
+        """
+        import ctypes, ctypes.util, sys
+        if not sys.platform.startswith("linux"):
+            return None
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            return None
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return None
+        if fd < 0:
+            return None
+        self.folders = {}
+        for folder in {path.parent for path in self.paths}:
+            wd = libc.inotify_add_watch(fd, str(folder).encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self.folders[wd] = folder
+        return fd
+
+    @staticmethod
+    def mtime(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def changes(self, timeout: Optional[float]) -> set:
+        """
+        Returns the notebooks which changed within `timeout` seconds (waiting forever if timeout is None)
+        """
+        if self.fd is not None:
+            import select
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return set()
+            data = os.read(self.fd, 65536)
+            changed, i = set(), 0
+            while i < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, i)
+                name = data[i + INOTIFY_EVENT_HEADER_SIZE : i + INOTIFY_EVENT_HEADER_SIZE + length].rstrip(b"\0").decode()
+                i += INOTIFY_EVENT_HEADER_SIZE + length
+                path = self.folders[wd] / name
+                if path in self.paths:
+                    changed.add(path)
+            return changed
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path in self.paths:
+                mtime = self.mtime(path)
+                if mtime != self.mtimes[path]:
+                    self.mtimes[path] = mtime
+                    changed.add(path)
+            if changed or (t_end is not None and time.monotonic() >= t_end):
+                return changed
+            time.sleep(self.poll_interval if t_end is None else max(0, min(self.poll_interval, t_end - time.monotonic())))
+
+    def wait(self) -> set:
+        """
+        Blocks until at least one notebook has been saved, and returns the notebooks which changed
+        """
+        changed = set()
+        while not changed:
+            changed = self.changes(None)
+        while True:
+            more = self.changes(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+
+def watch(paths: List[str], debounce:float=0.3, poll:bool=False, cache:Union[bool, str]=True, workers:Optional[int]=None, p_media:Optional[str]=None, optimize_images:Union[bool, Dict]=False):
+    """
+    Watches notebooks, and rebuilds their anki packages whenever they're saved (this runs until you stop it).
+
+    Each notebook gets written to the same packages as `write_cards_to_anki_package(filename, overwrite=True)` would
+    write. The render cache is kept in memory between builds, so only the cells which have changed are rendered again,
+    and only the decks whose cards have changed get their packages written again.
+
+    Arguments are:
+        paths
+            list of notebooks, or directories containing notebooks (new notebooks added to these directories aren't picked up)
+        debounce
+            number of seconds to wait for more saves before rebuilding
+        poll
+            if True, poll the notebooks for changes rather than using inotify
+        cache, workers, p_media, optimize_images
+            same as for `write_cards_to_anki_package`
+    """
+    optimize_images = ImageOptimizer.from_arg(optimize_images) or False
+    notebooks = find_notebooks(paths)
+    render_caches = {}
+    deck_hashes = defaultdict(dict)
+
+    def build(notebook: Path):
+        t0 = time.perf_counter()
+        if notebook not in render_caches:
+            render_caches[notebook] = RenderCache(notebook.parent / ".jupyter_to_anki_cache.json" if cache is True else cache) if cache else False
+        card_dict_by_deck_and_type = defaultdict(lambda: defaultdict(list))
+        with using_media(p_media, optimize_images):
+            try:
+                for deck, card_type, fields, tags, guid in iter_cards(str(notebook), None, render_caches[notebook], workers, require_call_cell=False):
+                    card_dict_by_deck_and_type[deck][card_type].append((fields, tags, guid))
+            # if the notebook can't be read (e.g. it was saved half-way through an edit), the packages from the last build
+            # are kept until it's saved again
+            except:
+                print_read_error()
+                print(f"Couldn't read {str(notebook)!r}, so its packages haven't been changed.")
+                return
+        decks_written = []
+        for deck, card_dict_by_type in card_dict_by_deck_and_type.items():
+            h = hashlib.sha256(json.dumps(card_dict_by_type).encode()).hexdigest()
+            if deck_hashes[notebook].get(deck) != h:
+                write_deck_package(deck, card_dict_by_type, str(notebook.with_suffix("")), overwrite=True)
+                deck_hashes[notebook][deck] = h
+                decks_written.append(deck)
+        print(f"Built {str(notebook)!r} in {time.perf_counter() - t0:.2f}s (decks written: {', '.join(decks_written) or 'none'})")
+
+    for notebook in notebooks:
+        build(notebook)
+    watcher = NotebookWatcher([notebook.resolve() for notebook in notebooks], debounce, poll)
+    print(f"Watching {len(notebooks)} notebooks ({'polling' if watcher.fd is None else 'inotify'}). Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = watcher.wait()
+            for notebook in notebooks:
+                if notebook.resolve() in changed:
+                    build(notebook)
+    except KeyboardInterrupt:
+        pass
+
+
+### COMMAND LINE
+
+def main(argv:Optional[List[str]]=None):
+    """
+    Command line interface, e.g. `python -m jupyter_to_anki build notebooks/ -o anki.apkg`
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m jupyter_to_anki", description="Turn Jupyter notebooks into Anki cards.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_build = subparsers.add_parser("build", help="write the cards from every notebook into a single anki package")
+    parser_build.add_argument("paths", nargs="+", help="notebooks, or directories to search for notebooks")
+    parser_build.add_argument("-o", "--output", default="anki.apkg", help="filename of the anki package (default: anki.apkg)")
+    parser_build.add_argument("--force", action="store_true", help="read every notebook, even the ones which haven't changed")
+    parser_build.add_argument("--cache", action="store_true", help="reuse rendered cards from the render cache")
+    parser_build.add_argument("--workers", type=int, default=None, help="render cards in a pool of this many processes")
+    parser_build.add_argument("--delta", action="store_true", help="only write the cards which were added or changed since the last build")
+    parser_build.add_argument("--media", default=None, help="the folder images are written to (Anki's collection.media folder)")
+    parser_build.add_argument("--writer", choices=["genanki", "sqlite"], default="genanki", help="how the package is written (sqlite is faster for big decks)")
+    parser_build.add_argument("--bundle-media", action="store_true", help="put the images inside the package, rather than only in the media folder")
+    add_image_arguments(parser_build)
+    parser_build.add_argument("--duplicates", choices=["report", "drop"], default=None, help="print cards which are duplicates of other cards, or leave them out of the package")
+    parser_build.add_argument("--duplicate-threshold", type=float, default=0.7, help="how similar cards have to be to count as near-duplicates (default: 0.7)")
+    parser_watch = subparsers.add_parser("watch", help="rebuild the anki packages of notebooks whenever they're saved")
+    parser_watch.add_argument("paths", nargs="+", help="notebooks, or directories containing notebooks")
+    parser_watch.add_argument("--debounce", type=float, default=0.3, help="seconds to wait for more saves before rebuilding (default: 0.3)")
+    parser_watch.add_argument("--poll", action="store_true", help="poll the notebooks for changes, rather than using inotify")
+    parser_watch.add_argument("--no-cache", action="store_true", help="don't use the render cache")
+    parser_watch.add_argument("--workers", type=int, default=None, help="render cards in a pool of this many processes")
+    parser_watch.add_argument("--media", default=None, help="the folder images are written to (Anki's collection.media folder)")
+    add_image_arguments(parser_watch)
+    parser_lint = subparsers.add_parser("lint", help="check the cards in notebooks without building them (exits with 1 if there are errors)")
+    parser_lint.add_argument("paths", nargs="+", help="notebooks, or directories to search for notebooks")
+    parser_lint.add_argument("--workers", type=int, default=None, help="check notebooks in a pool of this many processes (default: one per CPU)")
+    parser_lint.add_argument("--format", choices=["text", "json"], default="text", help="print one problem per line, or all of them as a JSON list")
+    parser_lint.add_argument("--strict", action="store_true", help="exit with 1 if there are warnings, as well as errors")
+    args = parser.parse_args(argv)
+
+    if args.command == "lint":
+        diagnostics = lint_notebooks(args.paths, args.workers)
+        if args.format == "json":
+            print(json.dumps([diagnostic._asdict() for diagnostic in diagnostics], indent=1))
+        else:
+            for diagnostic in diagnostics: print(diagnostic)
+        return int(any(args.strict or diagnostic.severity == "error" for diagnostic in diagnostics))
+
+    # the image optimiser settings, if images are being optimised
+    optimize_images = args.optimize_images and {"max_size": args.max_image_size, "quality": args.image_quality, "format": args.image_format}
+
+    if args.command == "build":
+        return int(build_anki_package(args.paths, args.output, force=args.force, cache=args.cache, workers=args.workers, delta=args.delta, p_media=args.media, writer=args.writer, bundle_media=args.bundle_media, optimize_images=optimize_images, duplicates=args.duplicates, duplicate_threshold=args.duplicate_threshold) is None)
+    elif args.command == "watch":
+        watch(args.paths, args.debounce, args.poll, cache=not args.no_cache, workers=args.workers, p_media=args.media, optimize_images=optimize_images)
+
+
+def add_image_arguments(parser: "argparse.ArgumentParser") -> None:
+    parser.add_argument("--optimize-images", action="store_true", help="scale down and compress images before writing them (needs Pillow)")
+    parser.add_argument("--max-image-size", type=int, default=1600, help="with --optimize-images, the longest side of an image in pixels (default: 1600)")
+    parser.add_argument("--image-quality", type=int, default=85, help="with --optimize-images, the quality of jpg and webp images (default: 85)")
+    parser.add_argument("--image-format", choices=list(PILLOW_FORMATS), default=None, help="with --optimize-images, convert images to this format")
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,64 @@
+"""
+Tests of `clean_html_text`, which should give the same result as the BeautifulSoup pass which used to be run over the
+whole notebook (`clean_notebook_reference` below).
+
+Run from the root of the repo with:
+
+    python -m pytest tests
+"""
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import jupyter_to_anki
+
+PIECES = ["a", "b", " ", "<", ">", "&", ";", "/", "=", '"', "lt", "gt", "amp", "&lt;", "&gt;", "&amp;", "<b>", "</b>", "<a", "<script>", "<style>", "<!--", "-->", "#", "6", "<br>"]
+
+
+def clean_notebook_reference(s: str):
+    """
+    What the old version did to a string in the notebook (or None if it broke the notebook's JSON)
+    """
+    soup = BeautifulSoup(json.dumps({"cells": [s]}), "html.parser")
+    soup = BeautifulSoup(soup.text, "html.parser")
+    try:
+        return json.loads(soup.decode_contents())["cells"][0]
+    except ValueError:
+        return None
+
+
+@pytest.mark.parametrize("s, cleaned", [
+    ("a < b", "a &lt; b"),
+    ("a<b>c</b>&b", "ac&amp;b"),
+    ("x &lt", "x &lt;"),
+    ("  <br>=", "  ="),
+    ('say "hi"<script>a', 'say "hi"'),
+    ("x > y<script>abc", "x &gt; y"),
+    ("x<style>q", "x"),
+    # tags escaped as entities become real tags, and the quotes which end the string don't end up inside them
+    ("Use &lt;b&gt; for bold", "Use <b> for bold</b>"),
+    ("a &lt;b&gt;x&lt;/b&gt;", "a <b>x</b>"),
+    ("<a&gt;", "<a></a>"),
+    ('&lt;i&gt;"', '<i>"</i>'),
+])
+def test_clean_html_text(s, cleaned):
+    assert jupyter_to_anki.clean_html_text(s) == cleaned
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_clean_html_text_reference(seed):
+    r = random.Random(seed)
+    for _ in range(1000):
+        s = "".join(r.choice(PIECES) for _ in range(r.randint(1, 8)))
+        cleaned = jupyter_to_anki.clean_html_text(s)
+        cleaned_reference = clean_notebook_reference(s)
+        if cleaned_reference is not None:
+            assert cleaned == cleaned_reference, s
+        # (the old version broke the notebook when the quote ended up in a tag, but it still shouldn't be in the card)
+        elif '"' not in s:
+            assert '"' not in cleaned.replace('=""', ""), s
@@ -0,0 +1,78 @@
+"""
+Differential tests, which check that the linear-time implementations give exactly the same output as the original ones
+they replaced (`compile_blocks_reference` and `markdown_to_html_ignoring_codeblock_reference`), on random fields.
+
+Run from the root of the repo with:
+
+    python -m pytest tests
+"""
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import jupyter_to_anki
+
+WORDS = ["alpha", "beta", "x_1", "f(x)", "a*b", "**bold**", "*it*", "`code`", "`longer code`", "(S)", "&", "<br>", "\\n", "#"]
+LINES = [
+    lambda r: "* " + text(r),
+    lambda r: f"{r.randint(1, 12)}. " + text(r),
+    lambda r: "    " + text(r),
+    lambda r: "    ",
+    lambda r: "(Q)",
+    lambda r: "",
+    lambda r: text(r),
+    lambda r: "`" + text(r) + "`",
+    lambda r: "* ",
+    lambda r: "(S)" + text(r) + "(S)",
+]
+
+
+def text(r: random.Random) -> str:
+    return " ".join(r.choice(WORDS) for _ in range(r.randint(0, 5)))
+
+
+def random_field(r: random.Random) -> list:
+    return [r.choice(LINES)(r) + r.choice(["", "\n", "  "]) for _ in range(r.randint(1, 12))]
+
+
+def run(f, *args):
+    """
+    Returns the output of f (or the type of exception it raised), and the warnings it gave
+    """
+    jupyter_to_anki.render_state.warnings = []
+    try:
+        out = f(*args)
+    except Exception as e:
+        out = type(e)
+    finally:
+        warnings, jupyter_to_anki.render_state.warnings = jupyter_to_anki.render_state.warnings, None
+    return out, warnings
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_compile_blocks(seed):
+    r = random.Random(seed)
+    for _ in range(500):
+        field = random_field(r)
+        assert run(jupyter_to_anki.compile_blocks, list(field), {}) == run(jupyter_to_anki.compile_blocks_reference, list(field), {}), field
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_markdown_to_html_ignoring_codeblock(seed):
+    r = random.Random(seed)
+    for _ in range(500):
+        # either a compiled field (which has codeblocks and line breaks in it), or a line of inline markdown
+        if r.random() < 0.5:
+            s, _ = run(jupyter_to_anki.compile_blocks_reference, random_field(r), {})
+            if not isinstance(s, str):
+                continue
+        else:
+            s = "".join(r.choice(WORDS + ["*", "**", "`", "(S)", " "]) for _ in range(r.randint(1, 20)))
+        out, out_reference = run(jupyter_to_anki.markdown_to_html_ignoring_codeblock, s), run(jupyter_to_anki.markdown_to_html_ignoring_codeblock_reference, s)
+        # this is the one documented difference (the reference version loses codeblocks between two backticks)
+        if "&B" in out_reference[0] and "&B" not in s:
+            continue
+        assert out == out_reference, s